@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+# Benchmarks for the daily scraper.  Run everything or just some with:
+#   python data-processing/benchmark-scraper.py [benchmark ...]
+
+import os
+import sys
+import imp
+import time
+import shutil
+import urllib
+import resource
+import tempfile
+import numpy
+import multiprocessing
+import dateutil.parser
+from BeautifulSoup import BeautifulSoup
+from datetime import date, timedelta
+
+
+# Never let a benchmark write to the real scraper database
+os.environ['SCRAPERWIKI_DATABASE_NAME'] = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite')
+scraper_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'daily-scraperwiki.py')
+daily = imp.load_source('daily_scraperwiki', scraper_path)
+
+# Files in the format of each source, for one station, as they would have
+# been on the day below.  See fixtures/README.md
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+fixtures_date = date(2014, 3, 10)
+
+
+# Run a function over each row a few times and return the best
+# time per row in microseconds
+def time_per_row(func, rows, repeat = 3):
+  best = None
+  for r in range(0, repeat):
+    start = time.time()
+    for row in rows:
+      func(*row)
+    elapsed = time.time() - start
+    best = elapsed if best is None or elapsed < best else best
+
+  return (best * 1000000) / len(rows)
+
+# Print out a result line
+def report(name, per_row, baseline = None, unit = 'row'):
+  speedup = ' (%.1fx)' % (baseline / per_row) if baseline else ''
+  print '  %-32s %8.2f us/%s%s' % (name, per_row, unit, speedup)
+
+
+
+# Making dates from the year, month and day numbers the parsers already have
+def benchmark_dates():
+  scraper = daily.DailyWeatherScraper()
+  rows = [(y, m, d) for y in range(1871, 2015) for m in range(1, 13) for d in range(1, 29)]
+  normals_rows = [(m, d) for y in range(0, 30) for m in range(1, 13) for d in range(1, 29)]
+
+  print 'Dates (%s rows)' % len(rows)
+  before = time_per_row(lambda y, m, d: dateutil.parser.parse('%s-%s-%s' % (y, m, d)).date(), rows)
+  report('dateutil.parser.parse', before)
+  report('make_date', time_per_row(scraper.make_date, rows), before)
+  report('normals_date', time_per_row(scraper.normals_date, normals_rows), before)
+
+
+# Pages laid out like the U of M decade pages, the NWS monthly reports
+# and the NWS observation history
+def html_pages():
+  mn = '<html><body><p><font face="Arial">Twin Cities</font></p><pre><font face="Courier New">Twin Cities Daily Data\r\n'
+  mn = mn + ''.join('1990\t%s\t%s\t%s\t%s\t0.12\tT\tM\r\n' % (d % 12 + 1, d % 28 + 1, d % 90, d % 40) for d in range(0, 3653))
+  mn = mn + '</font></pre></body></html>'
+
+  nws_monthly = '<html><body><h2>CF6 report</h2><font size="3">\n' + ('=' * 80 + '\n') * 2
+  nws_monthly = nws_monthly + ''.join('%2d  23   5  14  -5  30   0  0.12    T    6 10.2 22 310   M    M   8 18     29 320\n' % d for d in range(1, 32))
+  nws_monthly = nws_monthly + '=' * 80 + '\n</font></body></html>'
+
+  nws_recent = '<html><body><table cellspacing="3" cellpadding="2" border="0" width="670"><tr><th>Date</th></tr>'
+  nws_recent = nws_recent + ''.join('<tr align="center"><td>%s</td><td>%02d:53</td>%s</tr>' % (10 - h / 24, h % 24, '<td>24</td>' * 16) for h in range(0, 72))
+  nws_recent = nws_recent + '</table></body></html>'
+
+  return mn, nws_monthly, nws_recent
+
+# Finding the text or table we want in a page, with BeautifulSoup and with
+# the scraper's own extraction
+def benchmark_html():
+  scraper = daily.DailyWeatherScraper()
+  mn, nws_monthly, nws_recent = html_pages()
+  table = { 'cellspacing': '3', 'cellpadding': '2', 'border': '0', 'width': '670' }
+
+  print 'HTML pages'
+  before = time_per_row(lambda p: BeautifulSoup(p)('font', face = 'Courier New')[0].contents[0], [(mn,)] * 5)
+  report('U of M BeautifulSoup', before, unit = 'page')
+  report('U of M html_text', time_per_row(lambda p: scraper.html_text(p, 'font', face = 'Courier New'), [(mn,)] * 5), before, 'page')
+
+  before = time_per_row(lambda p: BeautifulSoup(p)('font', size = '3')[0].contents[0], [(nws_monthly,)] * 20)
+  report('NWS monthly BeautifulSoup', before, unit = 'page')
+  report('NWS monthly html_text', time_per_row(lambda p: scraper.html_text(p, 'font', size = '3'), [(nws_monthly,)] * 20), before, 'page')
+
+  before = time_per_row(lambda p: [[c.string for c in r.findAll('td')] for r in BeautifulSoup(p).find('table', **table).findAll('tr')], [(nws_recent,)] * 20)
+  report('NWS recent BeautifulSoup', before, unit = 'page')
+  report('NWS recent html_table_cells', time_per_row(lambda p: scraper.html_table_cells(p, **table), [(nws_recent,)] * 20), before, 'page')
+
+
+# A scraper that reads fixtures instead of the real sources, as of the day
+# they are from, and doesn't cache, export, archive or save run reports
+def fixture_scraper(directory = fixtures_dir, stations = None):
+  scraper = daily.DailyWeatherScraper()
+  scraper.cache_dir = None
+  scraper.export_dir = None
+  scraper.archive_dir = None
+  scraper.save_runs = False
+  scraper.stations = stations or scraper.stations
+  scraper.mn_decades = [1990]
+
+  url = 'file://' + urllib.pathname2url(os.path.abspath(directory)) + '/'
+  scraper.ghcn_url_template = url + '%(ghcn_station)s.dly'
+  scraper.normals_url_template = url + '%(ghcn_station)s.normals.txt'
+  scraper.gsod_url_template = url + '%(gsod_station)s-%(year)s.op.gz'
+  scraper.mn_url_template = url + 'msp%(mn_decade)s\'s.htm'
+  scraper.nws_monthly_url_template = url + 'cf6-%(end_month_date)s.htm'
+  scraper.nws_recent_url_template = url + '%(airport_id)s.html'
+
+  scraper.today = scraper.date = fixtures_date
+  scraper.year = fixtures_date.year
+  scraper.recent = fixtures_date - timedelta(days = 30)
+  scraper.recent_year = scraper.recent.year
+  return scraper
+
+# Run a function in its own process with its own empty database and none
+# of the scraper's printing.  Returns what the function returns and the
+# peak memory of the process in MB
+def in_process(func, *args):
+  results = multiprocessing.Queue()
+
+  def run():
+    sys.stdout = open(os.devnull, 'w')
+    daily.scraperwiki.sqlite._connect(os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite'))
+    result = func(*args)
+    results.put((result, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+  process = multiprocessing.Process(target = run)
+  process.start()
+  result = results.get()
+  process.join()
+  return result
+
+# Run part of the scraper as a stage and return the run's stats.  Rows are
+# counted once for each table they are saved to
+def run_source(recent, method):
+  scraper = fixture_scraper()
+  scraper.isRecent = recent
+  scraper.station = scraper.stations[0]
+  scraper.migrate_schema()
+  scraper.run_stage('source', getattr(scraper, method))
+  return scraper.stages['source']
+
+# Print out a result line for a run
+def report_run(name, stats, peak):
+  rows = stats.get('rows_parsed', 0)
+  print '  %-32s %8.2f s %8d rows %10.0f rows/s %8.1f MB peak' % (name, stats['seconds'], rows, rows / stats['seconds'], peak)
+
+
+# Parsing and saving each source from the fixtures
+def benchmark_sources():
+  print 'Sources (one station)'
+  for name, recent, method in [
+    ('GHCN', False, 'process_ghcn'),
+    ('Normals', False, 'process_normals'),
+    ('U of M', False, 'process_mn_climate'),
+    ('GSOD', True, 'process_gsod'),
+    ('NWS monthly', True, 'process_nws_monthly'),
+    ('NWS recent', True, 'process_nws_recent')]:
+    stats, peak = in_process(run_source, recent, method)
+    report_run(name, stats, peak)
+
+# Make fixtures for a number of made up stations by copying the GHCN and
+# normals files under new station IDs, and return the directory and the
+# stations
+def synthetic_stations(count):
+  directory = tempfile.mkdtemp()
+  stations = []
+  for f in os.listdir(fixtures_dir):
+    shutil.copy(os.path.join(fixtures_dir, f), directory)
+
+  with open(os.path.join(fixtures_dir, 'USW00014922.dly'), 'rb') as ghcn:
+    lines = ghcn.readlines()
+
+  for i in range(0, count):
+    station = 'USW9%07d' % i
+    with open(os.path.join(directory, station + '.dly'), 'wb') as ghcn:
+      ghcn.writelines(station + l[11:] for l in lines)
+    shutil.copy(os.path.join(fixtures_dir, 'USW00014922.normals.txt'), os.path.join(directory, station + '.normals.txt'))
+    stations.append((station, '726580-14922', 'KMSP', 'MPX', 'MSP'))
+
+  return directory, stations
+
+# Run a historical run over the synthetic stations
+def run_historical(directory, stations, processes):
+  scraper = fixture_scraper(directory, stations)
+  scraper.processes = processes
+  scraper.process_historical()
+  return { 'rows_parsed': sum(s.get('rows_parsed', 0) for s in scraper.stages.values()) }
+
+# Historical runs with more and more made up stations
+def benchmark_stations():
+  print 'Historical runs (stations)'
+  for count in [1, 2, 4, 8]:
+    directory, stations = synthetic_stations(count)
+    for processes in sorted(set([1, min(count, multiprocessing.cpu_count())])):
+      started = time.time()
+      stats, peak = in_process(run_historical, directory, stations, processes)
+      stats['seconds'] = time.time() - started
+      report_run('%s stations, %s processes' % (count, processes), stats, peak)
+    shutil.rmtree(directory)
+
+
+# Time the average departure from normal high over a station's whole
+# history, from the database and from its archive, after a historical run.
+# Returns the time for each in microseconds
+def run_archive():
+  scraper = fixture_scraper()
+  scraper.archive_dir = tempfile.mkdtemp()
+  scraper.process_historical()
+  station = scraper.stations[0][0]
+  start, end = date(1870, 1, 1), fixtures_date
+
+  def from_database():
+    rows = daily.scraperwiki.sqlite.execute('SELECT tmax, ntmax FROM daily_summary WHERE station = ? AND date >= ? AND date <= ?',
+      [station, str(start), str(end)])
+    values = numpy.array(rows['data'], dtype = float)
+    return numpy.nanmean(values[:, 0] - values[:, 1])
+
+  def from_archive():
+    days = scraper.load_archive(station, start, end, ['tmax', 'ntmax'])
+    return numpy.nanmean(days['tmax'] - days['ntmax'])
+
+  times = time_per_row(from_database, [()] * 5), time_per_row(from_archive, [()] * 5)
+  shutil.rmtree(scraper.archive_dir)
+  return times
+
+# Reading a long range of a few measurements from the database and from
+# the columnar archive
+def benchmark_archive():
+  print 'Archive (%s to %s)' % (date(1870, 1, 1), fixtures_date)
+  (before, after), peak = in_process(run_archive)
+  report('daily_summary query', before, unit = 'query')
+  report('load_archive', after, before, 'query')
+
+
+benchmarks = {
+  'archive': benchmark_archive,
+  'dates': benchmark_dates,
+  'html': benchmark_html,
+  'sources': benchmark_sources,
+  'stations': benchmark_stations
+}
+
+
+# Main execution
+if __name__ == '__main__':
+  names = sys.argv[1:] if len(sys.argv) > 1 else sorted(benchmarks.keys())
+  for name in names:
+    benchmarks[name]()
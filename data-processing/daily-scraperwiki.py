@@ -5,17 +5,39 @@
 # https://github.com/MinnPost/minnpost-climate#data
 
 import scraperwiki
+import os
+import re
 import gzip
+import tarfile
+import zlib
+import time
+import urllib
 import urllib2
+import urlparse
 import StringIO
-import dateutil.parser
+import threading
+import multiprocessing
 import json
+import hashlib
+import bisect
+import struct
 import pytz
+import numpy
 from BeautifulSoup import BeautifulSoup
+from collections import OrderedDict, namedtuple
+from itertools import groupby
 from datetime import datetime, date, timedelta
 from dateutil.relativedelta import relativedelta
 
 
+# Run stats are counted from fetch threads too
+stats_lock = threading.Lock()
+
+# A GHCN value as parsed, with the measurement's three flag characters
+# (measurement, quality and source) as they are in the file.  These only
+# become rows when they are saved.
+GhcnValue = namedtuple('GhcnValue', ['station', 'year', 'month', 'day', 'element', 'value', 'flags'])
+
 class DailyWeatherScraper:
 
   # Stations
@@ -33,8 +55,20 @@ class DailyWeatherScraper:
   nws_monthly_url_template = 'http://www.nws.noaa.gov/climate/getclimate.php?date=&wfo=%(wfo_id)s&sid=%(sid_id)s&pil=CF6&recent=&specdate=%(end_month_date)s+11:11:11'
   nws_recent_url_template = 'http://w1.weather.gov/data/obhistory/%(airport_id)s.html'
 
+  # Tags and attributes in the HTML pages, to find what we want without
+  # parsing the whole page
+  html_tag = re.compile(r'<(/?)(font|h2|table|tr|td)\b([^>]*)>', re.I)
+  html_attribute = re.compile(r'([\w-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))')
+
   # Measurements to keep
   ghcn_measurements = ['tmax', 'tmin', 'prcp', 'snow', 'snwd']
+  # Where each day's value starts and ends in a GHCN line; the three
+  # flags follow the value
+  ghcn_day_columns = [(21 + (d * 8), 26 + (d * 8)) for d in range(0, 31)]
+  # How many GHCN values to collect before converting them all at once
+  ghcn_chunk_size = 20000
+  # Normals section keywords look like dly-tmax-normal or mtd-prcp-normal
+  normals_keyword = re.compile(r'^[a-z]{3}-[a-z0-9-]+$')
   normals_measurements = [
     # Section keyword, db field to save to, how to process value
     ('dly-tmax-normal', 'ntmax', 'temp'),
@@ -45,8 +79,164 @@ class DailyWeatherScraper:
   ]
 
 
+  # Tables, as unique keys, typed columns and other indexes.  Every day
+  # table can be found by station and date or by station and day of year
+  day_keys = ['station', 'year', 'month', 'day']
+  day_columns = [('station', 'text'), ('source', 'text'), ('year', 'integer'), ('month', 'integer'), ('day', 'integer'), ('date', 'date')]
+  day_indexes = [['station', 'date'], ['station', 'month', 'day']]
+  # Columns of the monthly and yearly rollups and how each is aggregated
+  # from the daily summary
+  rollup_columns = [
+    ('days', 'integer', 'COUNT(*)'),
+    ('tmax', 'real', 'ROUND(AVG(tmax), 2)'),
+    ('tmin', 'real', 'ROUND(AVG(tmin), 2)'),
+    ('tavg', 'real', 'ROUND(AVG(tavg), 2)'),
+    ('max_tmax', 'real', 'MAX(tmax)'),
+    ('min_tmin', 'real', 'MIN(tmin)'),
+    ('prcp', 'real', 'ROUND(SUM(prcp), 2)'),
+    ('snow', 'real', 'ROUND(SUM(snow), 2)'),
+    ('ntmax', 'real', 'ROUND(AVG(ntmax), 2)'),
+    ('ntmin', 'real', 'ROUND(AVG(ntmin), 2)'),
+    ('ntavg', 'real', 'ROUND(AVG(ntavg), 2)'),
+    ('nprcp', 'real', 'ROUND(SUM(nprcp), 2)'),
+    ('nsnow', 'real', 'ROUND(SUM(nsnow), 2)'),
+    ('tavg_departure', 'real', 'ROUND(AVG(tavg_departure), 2)'),
+    ('prcp_departure', 'real', 'ROUND(SUM(prcp_departure), 2)'),
+    ('snow_departure', 'real', 'ROUND(SUM(snow_departure), 2)')
+  ]
+  schema = OrderedDict([
+    ('ghcn', (day_keys, day_columns + [
+      ('tmax', 'real'), ('tmax_f', 'text'), ('tmin', 'real'), ('tmin_f', 'text'),
+      ('prcp', 'real'), ('prcp_f', 'text'), ('snow', 'real'), ('snow_f', 'text'),
+      ('snwd', 'real'), ('snwd_f', 'text')
+    ], day_indexes)),
+    ('gsod', (day_keys, day_columns + [
+      ('gsod_station', 'text'), ('wban', 'text'), ('tavg', 'real'), ('tmax', 'real'),
+      ('tmin', 'real'), ('prcp', 'real'), ('prcp_f', 'text'), ('snwd', 'real')
+    ], day_indexes)),
+    ('mn_climate', (day_keys, day_columns + [
+      ('mn_climate_station', 'text'), ('tmax', 'real'), ('tmin', 'real'),
+      ('prcp', 'real'), ('snow', 'real'), ('snwd', 'real')
+    ], day_indexes)),
+    ('nws', (day_keys, day_columns + [
+      ('wfo', 'text'), ('tmax', 'real'), ('tmin', 'real'), ('tavg', 'real'),
+      ('prcp', 'real'), ('snow', 'real'), ('snwd', 'real')
+    ], day_indexes)),
+    ('nws_recent', (day_keys, day_columns + [
+      ('nws_airpot', 'text'), ('tmax', 'real'), ('tmin', 'real'), ('tavg', 'real'),
+      ('prcp', 'real')
+    ], day_indexes)),
+    # The dashboard looks up observations by date alone and joins them to
+    # normals by month and day
+    ('observations', (day_keys, day_columns + [
+      ('tmax', 'real'), ('tmax_f', 'text'), ('tmin', 'real'), ('tmin_f', 'text'),
+      ('tavg', 'real'), ('prcp', 'real'), ('prcp_f', 'text'), ('snow', 'real'),
+      ('snow_f', 'text'), ('snwd', 'real'), ('snwd_f', 'text'),
+      ('mn_climate_station', 'text'), ('gsod_station', 'text'), ('wban', 'text'),
+      ('wfo', 'text'), ('nws_airpot', 'text')
+    ], day_indexes + [['date']])),
+    ('normals', (['station', 'month', 'day'], [
+      ('station', 'text'), ('month', 'integer'), ('day', 'integer'), ('date', 'date'),
+      ('ntmax', 'real'), ('ntmax_f', 'text'), ('ntmin', 'real'), ('ntmin_f', 'text'),
+      ('ntavg', 'real'), ('ntavg_f', 'text'), ('nprcp', 'real'), ('nprcp_f', 'text'),
+      ('nsnow', 'real'), ('nsnow_f', 'text')
+    ], [['station', 'date'], ['month', 'day']])),
+    # Observations with their normals, average temperature and departures
+    # from normal, and monthly and yearly rollups of those.  These are made
+    # in the database from the tables above (see refresh_summaries)
+    ('daily_summary', (day_keys, day_columns + [
+      ('tmax', 'real'), ('tmin', 'real'), ('tavg', 'real'), ('prcp', 'real'),
+      ('snow', 'real'), ('snwd', 'real'), ('ntmax', 'real'), ('ntmin', 'real'),
+      ('ntavg', 'real'), ('nprcp', 'real'), ('nsnow', 'real'),
+      ('tmax_departure', 'real'), ('tmin_departure', 'real'), ('tavg_departure', 'real'),
+      ('prcp_departure', 'real'), ('snow_departure', 'real')
+    ], day_indexes + [['date']])),
+    ('monthly_summary', (['station', 'year', 'month'], [
+      ('station', 'text'), ('year', 'integer'), ('month', 'integer')
+    ] + [(c, t) for c, t, a in rollup_columns], [['year', 'month']])),
+    ('yearly_summary', (['station', 'year'], [
+      ('station', 'text'), ('year', 'integer')
+    ] + [(c, t) for c, t, a in rollup_columns], [['year']])),
+    # Records, percentiles and every value, sorted, of each measurement for
+    # each day of the year (see refresh_day_records)
+    ('day_records', (['station', 'month', 'day', 'measurement'], [
+      ('station', 'text'), ('month', 'integer'), ('day', 'integer'), ('measurement', 'text'),
+      ('count', 'integer'), ('high', 'real'), ('high_year', 'integer'), ('low', 'real'),
+      ('low_year', 'integer'), ('mean', 'real'), ('p10', 'real'), ('p25', 'real'),
+      ('p50', 'real'), ('p75', 'real'), ('p90', 'real'), ('sorted_values', 'text')
+    ], [])),
+    # Days where two sources disagree on a measurement by more than its
+    # threshold (see validate_sources)
+    ('discrepancies', (['station', 'date', 'measurement', 'source', 'other_source'], [
+      ('station', 'text'), ('year', 'integer'), ('month', 'integer'), ('day', 'integer'),
+      ('date', 'date'), ('measurement', 'text'), ('source', 'text'), ('value', 'real'),
+      ('other_source', 'text'), ('other_value', 'real'), ('difference', 'real')
+    ], [['date'], ['source', 'other_source', 'measurement']]))
+  ])
+
+  # Measurements to keep records for, for each day of the year
+  record_measurements = ['tmax', 'tmin', 'prcp', 'snow']
+
+  # Sources that make up observations, from the one to use first.  Each
+  # value comes from the first source that has it for the day, except that
+  # each group of columns comes from the first source with any of them, so
+  # a day's average is never from a different source than its high and
+  # low, and the station columns only come from the day's source
+  observation_sources = ['ghcn', 'nws_recent', 'nws', 'gsod', 'mn_climate']
+  observation_groups = [['tmax', 'tmin', 'tavg']]
+  observation_station_columns = ['mn_climate_station', 'gsod_station', 'wban', 'wfo', 'nws_airpot']
+
+  # How far apart two sources can be on a measurement before it counts
+  # as a discrepancy, in degrees or inches
+  discrepancy_thresholds = OrderedDict([
+    ('tmax', 5), ('tmin', 5), ('tavg', 5), ('prcp', 0.5), ('snow', 2), ('snwd', 3)
+  ])
+
+  # Number of rows per table to hold before writing to the database
+  batch_size = 5000
+
+  # Where to keep downloaded files, laid out by scheme, host and path.  Set
+  # to None to always download.  FTP can't tell us if a file has changed,
+  # so cached FTP files are trusted for a while (in seconds)
+  cache_dir = os.environ.get('CLIMATE_CACHE_DIR', 'cache')
+  cache_ftp_ttl = 6 * 60 * 60
+
+  # How many processes to parse station files with in a historical run.
+  # With 1, everything is parsed in this process
+  processes = 1
+
+  # How many downloads to run at once, in total and against any one host
+  fetch_workers = 8
+  fetch_host_limit = 2
+
+  # Where to write static files of the summaries, by station, for the
+  # dashboard to fetch instead of querying the database.  Set to None to
+  # not write them
+  export_dir = os.environ.get('CLIMATE_EXPORT_DIR', 'export')
+  # Columns exported for each day, and the day of year records exported,
+  # as measurement and whether the record is the highest or lowest value
+  export_columns = ['date', 'tmax', 'tmin', 'tavg', 'prcp', 'snow', 'snwd', 'ntmax', 'ntmin', 'ntavg', 'nprcp', 'nsnow']
+  export_records = [('tmax', 'MAX'), ('tmin', 'MIN'), ('prcp', 'MAX'), ('snow', 'MAX')]
+
+  # Where to keep a file of columns with each station's whole history, for
+  # analysis that reads a few measurements over many years (see
+  # refresh_archives).  Set to None to not write them
+  archive_dir = os.environ.get('CLIMATE_ARCHIVE_DIR', 'archive')
+  # Each file has a value for every day in this range for each of these
+  # columns, observations and the normals for the day
+  archive_start = date(1800, 1, 1)
+  archive_end = date(2100, 1, 1)
+  archive_columns = ['tmax', 'tmin', 'tavg', 'prcp', 'snow', 'snwd', 'ntmax', 'ntmin', 'ntavg', 'nprcp', 'nsnow']
+
+  # Each run reports how long each stage took and what it did as JSON.  The
+  # report is printed, written to a file if there is a path, and saved to
+  # the runs table unless turned off
+  report_path = os.environ.get('CLIMATE_REPORT_PATH')
+  save_runs = True
+
+
   # Constructor
-  def __init__(self):
+  def __init__(self, batch_size = None, cache_dir = None, offline = False, processes = None):
     self.isRecent = False
     self.now = datetime.now(pytz.timezone('US/Central'))
     self.date = self.now.date()
@@ -54,7 +244,21 @@ class DailyWeatherScraper:
     self.year = self.date.year
     self.recent = self.today - timedelta(days = 30)
     self.recent_year = self.recent.year
-    self.tables = []
+    self.tables = {}
+    self.buffers = {}
+    self.normals_dates = {}
+    self.ghcn_flags = {}
+    self.batch_size = batch_size or self.batch_size
+    self.processes = processes or self.processes
+    self.cache_dir = cache_dir or self.cache_dir
+    self.offline = offline
+    self.fetched = set()
+    self.sync_hashes = {}
+    self.sync_counts = {}
+    self.sync_last_dates = {}
+    self.stages = OrderedDict()
+    self.stage = None
+    self.run_started = None
 
 
 
@@ -102,6 +306,25 @@ class DailyWeatherScraper:
   def to_inches_from_mm(self, mm):
     return mm / 25.4
 
+  # Make a date from year, month and day numbers (or number strings).  This
+  # is much quicker than parsing a formatted string and raises a ValueError
+  # for anything that is not a real date
+  def make_date(self, year, month, day):
+    parts = [self.parse_num(p) if isinstance(p, basestring) else p for p in (year, month, day)]
+    for p in parts:
+      if not isinstance(p, (int, long)):
+        raise ValueError('Not a valid date: %s-%s-%s' % (year, month, day))
+
+    return date(parts[0], parts[1], parts[2])
+
+  # Normals use fake dates in 2000 (a leap year), so there are only 366 of
+  # them; keep them around instead of making them for every value
+  def normals_date(self, month, day):
+    key = (month, day)
+    if key not in self.normals_dates:
+      self.normals_dates[key] = self.make_date(2000, month, day)
+    return self.normals_dates[key]
+
   # Get last day of month of a date
   def last_day_of_month(self, d):
     # Add month and subtract a day from the first of the month
@@ -110,25 +333,133 @@ class DailyWeatherScraper:
 
 
 
-  # Open remote file, return file
+  # Open remote file, return file.  If there is a cache, the file is
+  # downloaded to it (or found there) and the local copy is returned.
   # See: http://stackoverflow.com/questions/16241469/decompress-remote-gz-file-in-python
-  def open_remote_file(self, url):
+  def open_remote_file(self, url, permanent = False):
+    if self.cache_dir:
+      return self.open_cached_file(url, permanent)
+
     response = urllib2.urlopen(url)
+    self.count('bytes_downloaded', int(response.info().get('Content-length') or 0))
 
     if '.gz' in url:
-      compressedFile = StringIO.StringIO()
-      compressedFile.write(response.read())
-      compressedFile.seek(0)
-      decompressedFile = gzip.GzipFile(fileobj = compressedFile, mode = 'rb')
-      return decompressedFile
+      return GzipLines(response)
     else:
       return response
 
+  # Get a file through the cache.  Permanent files (ones that never change)
+  # and files already fetched this run are used as is, FTP files are used
+  # until the TTL runs out or their size changes, and HTTP files are
+  # checked with their ETag or Last-Modified headers.  When offline, only
+  # the cache is used.
+  def open_cached_file(self, url, permanent = False):
+    path = self.cache_path(url)
+    meta = self.read_cache_meta(path)
+    is_ftp = url.startswith('ftp:')
+
+    if os.path.exists(path):
+      if self.offline or permanent or url in self.fetched:
+        return self.open_local_file(path, url)
+      if is_ftp and meta is not None and time.time() - meta['fetched'] < self.cache_ftp_ttl:
+        return self.open_local_file(path, url)
+
+    if self.offline:
+      raise urllib2.URLError('Not found in cache: %s' % url)
+
+    request = urllib2.Request(url)
+    if os.path.exists(path) and meta is not None:
+      if meta.get('etag'):
+        request.add_header('If-None-Match', meta['etag'])
+      if meta.get('last_modified'):
+        request.add_header('If-Modified-Since', meta['last_modified'])
+
+    try:
+      response = urllib2.urlopen(request)
+    except urllib2.HTTPError as ex:
+      if ex.code != 304:
+        raise
+      self.write_cache_meta(path, url, meta)
+      return self.open_local_file(path, url)
+
+    # FTP only gives us a size, so if that hasn't changed, keep what we have
+    headers = response.info()
+    size = headers.get('Content-length')
+    if is_ftp and meta is not None and os.path.exists(path) and size is not None and int(size) == meta['size']:
+      response.close()
+      self.write_cache_meta(path, url, meta)
+      return self.open_local_file(path, url)
+
+    # Download to a temporary file so that a failed download doesn't
+    # leave a partial file in the cache
+    try:
+      os.makedirs(os.path.dirname(path))
+    except OSError:
+      # Already there, maybe made by another download
+      if not os.path.isdir(os.path.dirname(path)):
+        raise
+    size = 0
+    sha1 = hashlib.sha1()
+    with open(path + '.download', 'wb') as download:
+      for chunk in iter(lambda: response.read(65536), ''):
+        download.write(chunk)
+        sha1.update(chunk)
+        size = size + len(chunk)
+    self.count('bytes_downloaded', size)
+    response.close()
+    os.rename(path + '.download', path)
+
+    self.write_cache_meta(path, url, {
+      'etag': headers.get('ETag'),
+      'last_modified': headers.get('Last-Modified'),
+      'size': size,
+      'sha1': sha1.hexdigest()
+    })
+    return self.open_local_file(path, url)
+
+  # Open a local copy of a file, decompressing if needed
+  def open_local_file(self, path, url):
+    self.fetched.add(url)
+    if '.gz' in url:
+      return GzipLines(open(path, 'rb'))
+    return open(path, 'rb')
+
+  # Where a URL is kept in the cache, for instance
+  # cache/ftp/ftp.ncdc.noaa.gov/pub/data/ghcn/daily/all/USW00014922.dly
+  def cache_path(self, url):
+    parts = urlparse.urlsplit(url)
+    path = [p for p in parts.path.split('/') if p not in ['', '.', '..']]
+    if parts.query:
+      path[-1] = path[-1] + '?' + parts.query
+    path = [urllib.quote(p, safe = " '?=&+:,.-_") for p in path]
+    return os.path.join(self.cache_dir, parts.scheme, parts.netloc or 'local', *path)
+
+  # Cache metadata (ETag, Last-Modified, size and when it was fetched) is
+  # kept next to the file
+  def read_cache_meta(self, path):
+    try:
+      with open(path + '.meta.json', 'rb') as meta_file:
+        return json.load(meta_file)
+    except (IOError, ValueError):
+      return None
+
+  def write_cache_meta(self, path, url, meta):
+    meta = dict(meta or {})
+    meta['url'] = url
+    meta['fetched'] = time.time()
+    if meta.get('size') is None:
+      meta['size'] = os.path.getsize(path)
+    with open(path + '.meta.json', 'wb') as meta_file:
+      json.dump(meta, meta_file)
+
   # Read url
-  def read_url(self, url, readlines = True):
+  def read_url(self, url, readlines = True, permanent = False):
+    started = time.time()
     try:
-      file = self.open_remote_file(url)
+      file = self.open_remote_file(url, permanent)
       data = file.readlines() if readlines else file
+      self.count('files')
+      self.count('fetch_seconds', time.time() - started)
       return data
     except urllib2.URLError:
       print "Could not find file for station %s: %s." % (self.station, url)
@@ -137,42 +468,347 @@ class DailyWeatherScraper:
       message = template.format(type(ex).__name__, ex.args)
       print message
 
+  # Download files into the cache ahead of parsing, a few at a time.  Takes
+  # a list of (url, permanent) pairs.  Files are queued by host and each
+  # thread takes the next file from a host with fewer than fetch_host_limit
+  # downloads going, so a host with many files doesn't hold up the others.
+  # Parsing and saving still happens one file at a time, so there is only
+  # ever one thing writing to the database
+  def prefetch(self, urls):
+    if not self.cache_dir or self.offline:
+      return
+
+    pending = OrderedDict()
+    active = {}
+    for url, permanent in OrderedDict.fromkeys(urls):
+      host = urlparse.urlsplit(url).netloc
+      pending.setdefault(host, []).append((url, permanent))
+      active[host] = 0
+    ready = threading.Condition()
+
+    # Take the next file from a host with room for another download,
+    # waiting if every host with files left is full.  Returns None when
+    # there are no files left
+    def next_job():
+      with ready:
+        while True:
+          if not any(pending.values()):
+            return None
+          for host, files in pending.items():
+            if files and active[host] < self.fetch_host_limit:
+              active[host] += 1
+              return host, files.pop(0)
+          ready.wait()
+
+    def worker():
+      while True:
+        job = next_job()
+        if job is None:
+          return
+
+        host, (url, permanent) = job
+        try:
+          self.open_remote_file(url, permanent).close()
+        except Exception as ex:
+          # Reading the file later will report the problem
+          print 'Could not prefetch %s: %s' % (url, ex)
+
+        with ready:
+          active[host] -= 1
+          ready.notify_all()
+
+    count = sum(len(files) for files in pending.values())
+    print 'Prefetching %s files' % count
+    threads = [threading.Thread(target = worker) for i in range(0, min(self.fetch_workers, count))]
+    for t in threads:
+      t.daemon = True
+      t.start()
+    for t in threads:
+      t.join()
+
+  # All the files a run will read for the current station, as
+  # (url, permanent) pairs
+  def station_urls(self):
+    if not self.isRecent:
+      urls = [(self.ghcn_url(), False), (self.normals_url(), True)]
+      return urls + [(self.mn_url(decade), True) for decade in self.mn_decades]
+
+    urls = [(self.ghcn_url(), False)]
+    urls = urls + [(self.gsod_url(year), False) for year in self.gsod_years()]
+    urls = urls + [(self.nws_monthly_url(last_day), False) for last_day in self.nws_monthly_days()]
+    return urls + [(self.nws_recent_url(), False)]
+
+  # URLs for each source, for the current station
+  def ghcn_url(self):
+    return self.ghcn_url_template % { 'ghcn_station': self.station[0] }
+
+  def normals_url(self):
+    return self.normals_url_template % { 'ghcn_station': self.station[0], 'year': self.year }
+
+  def gsod_url(self, year):
+    return self.gsod_url_template % { 'gsod_station': self.station[1], 'year': year }
+
+  def mn_url(self, decade):
+    return self.mn_url_template % { 'mn_decade': decade }
+
+  def nws_monthly_url(self, last_day):
+    url_date = '%s-%s-%s' % (last_day.year, last_day.month, last_day.day)
+    return self.nws_monthly_url_template % { 'wfo_id': self.station[3], 'sid_id': self.station[4], 'end_month_date': url_date }
+
+  def nws_recent_url(self):
+    return self.nws_recent_url_template % { 'airport_id': self.station[2] }
+
+  # GSOD files are by year, so we may need the previous year too
+  def gsod_years(self):
+    return [self.year] if self.year == self.recent_year else [self.year, self.recent_year]
+
+  # NWS monthly reports are found by the last day of the month, so
+  # determine what months are needed and get the last date of each :(
+  def nws_monthly_days(self):
+    last_month_days = []
+    last_month_days.append(self.last_day_of_month(self.date))
+    if self.recent.month != self.date.month:
+      last_month_days.append(self.last_day_of_month(self.recent))
+    return last_month_days
+
+
+
+
+  # Update data in a way that is not destructive.  Rows are buffered per
+  # table and merged with what is already there when the buffer is flushed
+  def update_data(self, data, keys, table = 'swdata'):
+    self.count('rows_parsed')
+
+    # In recent runs, only write rows that changed since the last run
+    row_hash = None
+    if self.isRecent:
+      row_hash = self.sync_row(data, table)
+      if row_hash is None:
+        return
+
+    buffer = self.buffers.get(table)
+    if buffer is None:
+      buffer = { 'keys': keys, 'rows': OrderedDict(), 'hashes': [] }
+      self.buffers[table] = buffer
+
+    # Merge with a row for the same day that is still waiting to be written
+    key = tuple(data[k] for k in keys)
+    current = buffer['rows'].get(key)
+    if current is not None:
+      current.update(data)
+    else:
+      buffer['rows'][key] = data.copy()
+
+    if row_hash is not None:
+      buffer['hashes'].append(row_hash)
+
+    if len(buffer['rows']) >= self.batch_size:
+      self.flush_data(table)
 
+  # Write out buffered rows, for one table or all of them.  Each table
+  # is written in one transaction with an upsert that only sets the
+  # columns we have, so existing values are kept
+  def flush_data(self, table = None):
+    tables = [table] if table is not None else self.buffers.keys()
 
+    for t in tables:
+      buffer = self.buffers.pop(t, None)
+      if buffer is None or len(buffer['rows']) == 0:
+        continue
 
-  # Update data in a way that is not destructive
-  def update_data(self, data, keys, table = 'swdata', doNotOverwriteGHCN = False):
-    # Make find query
-    query = "* FROM %s WHERE " % table
-    where = []
-    for k in keys:
-      if self.is_number(data[k]):
-        where.append(k + "=%s " % data[k])
+      started = time.time()
+      rows = buffer['rows'].values()
+      columns = self.prepare_table(t, buffer['keys'], rows)
+
+      # Group rows by the columns they have so each group is one statement
+      groups = {}
+      for row in rows:
+        fields = tuple(sorted(k for k in row.keys() if k in columns))
+        groups.setdefault(fields, []).append([row[k] for k in fields])
+
+      for fields, values in groups.items():
+        scraperwiki.sqlite.dt.cursor.executemany(
+          self.upsert_query(t, buffer['keys'], fields), values)
+
+      # Remember what was written in the same transaction
+      if len(buffer['hashes']) > 0:
+        scraperwiki.sqlite.dt.cursor.executemany(
+          'INSERT OR REPLACE INTO sync_rows (tbl, station, date, fields, hash) VALUES (?, ?, ?, ?, ?)', buffer['hashes'])
+
+      scraperwiki.sqlite.commit()
+      self.count('rows_written', len(rows))
+      self.count('db_seconds', time.time() - started)
+
+  # Make sure the table, its columns and its unique index exist, and return
+  # the columns the table has.  Columns that only ever have empty values
+  # are never created, same as scraperwiki.sql.save
+  def prepare_table(self, table, keys, rows):
+    if table not in self.tables:
+      self.tables[table] = set(scraperwiki.sqlite.dt.column_names(table)) if table in scraperwiki.sqlite.show_tables() else set()
+
+    sample = {}
+    for row in rows:
+      for k, v in row.items():
+        if v is not None and k not in self.tables[table] and k not in sample:
+          sample[k] = v
+
+    if len(sample) > 0:
+      scraperwiki.sqlite.dt.create_table(sample, table_name = table)
+      scraperwiki.sqlite.dt.create_index(keys, table, unique = True, if_not_exists = True)
+      self.tables[table].update(sample.keys())
+
+    return self.tables[table]
+
+  # Make sure every table in the schema exists with typed columns and
+  # indexes.  Tables made by older versions of the scraper took their
+  # column types from the first row saved, so those are rebuilt.
+  def migrate_schema(self):
+    existing = scraperwiki.sqlite.show_tables()
+
+    for table, (keys, columns, indexes) in self.schema.items():
+      if table not in existing:
+        print 'Creating table: %s' % table
+        self.create_typed_table(table, columns)
       else:
-        where.append(k + "='%s' " % data[k])
-    query = query + " AND ".join(where)
-
-    # Save.  We have to get the current data so that it does not
-    # overwrite things
-    if table in self.tables or table in scraperwiki.sqlite.show_tables():
-      # Store that we found the table locally so we don't have to query
-      # everytime
-      self.tables.append(table)
-
-      current = scraperwiki.sqlite.select(query)
-      if len(current) > 0:
-        current = current[0]
-
-        # Check to see if we should overwrite the GHCN data.  Overall, we
-        # don't want the GSOD data to overwrite any GHCN data.
-        if doNotOverwriteGHCN and current['source'] == 'ghcn':
-          return
+        current = OrderedDict((c['name'], c['type']) for c in scraperwiki.sqlite.dt.execute('PRAGMA table_info(`%s`)' % table, commit = False))
+        if len([c for c, t in columns if c in current and current[c].lower() != t]) > 0:
+          print 'Rebuilding table with column types: %s' % table
+          self.rebuild_table(table, columns, current)
+        else:
+          for c, t in columns:
+            if c not in current:
+              scraperwiki.sqlite.dt.execute('ALTER TABLE `%s` ADD COLUMN `%s` %s' % (table, c, t), commit = False)
+
+      scraperwiki.sqlite.dt.create_index(keys, table, unique = True, if_not_exists = True, commit = False)
+      for index in indexes:
+        scraperwiki.sqlite.dt.create_index(index, table, if_not_exists = True, commit = False)
+
+      self.tables[table] = set(scraperwiki.sqlite.dt.column_names(table))
+
+    scraperwiki.sqlite.commit()
+
+  # Create table from a list of (column, type) pairs
+  def create_typed_table(self, table, columns):
+    scraperwiki.sqlite.dt.execute('CREATE TABLE `%s` (%s)' % (table,
+      ', '.join('`%s` %s' % (c, t) for c, t in columns)), commit = False)
+
+  # Copy a table into a new one with the schema's column types, keeping any
+  # extra columns it has
+  def rebuild_table(self, table, columns, current):
+    names = [c for c, t in columns]
+    columns = columns + [(c, t) for c, t in current.items() if c not in names]
+    shared = ', '.join('`%s`' % c for c in current.keys())
+
+    self.create_typed_table(table + '__migrate', columns)
+    scraperwiki.sqlite.dt.execute('INSERT INTO `%s__migrate` (%s) SELECT %s FROM `%s`' % (table, shared, shared, table), commit = False)
+    scraperwiki.sqlite.dt.execute('DROP TABLE `%s`' % table, commit = False)
+    scraperwiki.sqlite.dt.execute('ALTER TABLE `%s__migrate` RENAME TO `%s`' % (table, table), commit = False)
+
+  # Make the tables that keep track of what recent runs have already saved:
+  # a hash of each row written and the state of each file read
+  def create_sync_tables(self):
+    if 'sync' in self.tables:
+      return
+
+    scraperwiki.sqlite.execute('CREATE TABLE IF NOT EXISTS sync_rows (tbl TEXT, station TEXT, date TEXT, fields TEXT, hash TEXT)')
+    scraperwiki.sqlite.execute('CREATE UNIQUE INDEX IF NOT EXISTS sync_rows_tbl_station_date_fields ON sync_rows (tbl, station, date, fields)')
+    scraperwiki.sqlite.execute('CREATE TABLE IF NOT EXISTS sync_state (source TEXT, station TEXT, url TEXT, fingerprint TEXT, last_date TEXT, inserted INTEGER, updated INTEGER, skipped INTEGER, synced TEXT)')
+    scraperwiki.sqlite.execute('CREATE UNIQUE INDEX IF NOT EXISTS sync_state_source_station_url ON sync_state (source, station, url)')
+    scraperwiki.sqlite.commit()
+    self.tables['sync'] = set()
+
+  # Hashes of rows saved for a table and station since the start of the
+  # recent window's month (NWS reports are whole months), by date and the
+  # fields the row had
+  def row_hashes(self, table, station):
+    if (table, station) not in self.sync_hashes:
+      self.create_sync_tables()
+      rows = scraperwiki.sqlite.execute('SELECT date, fields, hash FROM sync_rows WHERE tbl = ? AND station = ? AND date >= ?',
+        [table, station, str(date(self.recent.year, self.recent.month, 1))])
+      self.sync_hashes[(table, station)] = dict(((r[0], r[1]), r[2]) for r in rows['data'])
+
+    return self.sync_hashes[(table, station)]
+
+  # Compare a row to what was saved for it before and count it as inserted,
+  # updated or skipped.  Returns the hash row to save with it, or None if
+  # it has not changed.
+  def sync_row(self, data, table):
+    date_key = str(data['date'])
+    fields = ','.join(sorted(k for k in data.keys() if k not in ['station', 'date']))
+    row_hash = hashlib.sha1(json.dumps(sorted(data.items()), default = str)).hexdigest()
+    hashes = self.row_hashes(table, data['station'])
+    previous = hashes.get((date_key, fields))
+
+    counts = self.sync_counts.setdefault(table, { 'inserted': 0, 'updated': 0, 'skipped': 0 })
+    if date_key > self.sync_last_dates.get(table, ''):
+      self.sync_last_dates[table] = date_key
+
+    if previous == row_hash:
+      counts['skipped'] = counts['skipped'] + 1
+      return None
+
+    counts['inserted' if previous is None else 'updated'] = counts['inserted' if previous is None else 'updated'] + 1
+    hashes[(date_key, fields)] = row_hash
+    return (table, data['station'], date_key, fields, row_hash)
+
+  # Fingerprint of the cached copy of a file, if there is one
+  def url_fingerprint(self, url):
+    if not self.cache_dir:
+      return None
 
-        # Update data with current data
-        current.update(data)
-        data = current.copy()
+    path = self.cache_path(url)
+    meta = self.read_cache_meta(path)
+    if meta is not None and meta.get('sha1'):
+      return meta['sha1']
+    if os.path.exists(path):
+      with open(path, 'rb') as cached:
+        return hashlib.sha1(cached.read()).hexdigest()
+    return None
+
+  # Check if a file is the same as the last time a recent run read it, in
+  # which case there is nothing new in it
+  def file_unchanged(self, source, url):
+    if not self.isRecent:
+      return False
+
+    fingerprint = self.url_fingerprint(url)
+    if fingerprint is None:
+      return False
+
+    self.create_sync_tables()
+    found = scraperwiki.sqlite.execute('SELECT fingerprint FROM sync_state WHERE source = ? AND station = ? AND url = ?',
+      [source, self.station[0], url])
+    if len(found['data']) > 0 and found['data'][0][0] == fingerprint:
+      print 'No changes in %s file for station: %s' % (source, self.station[0])
+      return True
+    return False
+
+  # Record what a recent run read from a file and report how many rows
+  # were inserted, updated or skipped
+  def save_sync_state(self, source, url):
+    if not self.isRecent:
+      return
+
+    self.flush_data()
+    self.create_sync_tables()
+    counts = self.sync_counts.pop(source, { 'inserted': 0, 'updated': 0, 'skipped': 0 })
+    scraperwiki.sqlite.execute('INSERT OR REPLACE INTO sync_state (source, station, url, fingerprint, last_date, inserted, updated, skipped, synced) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+      [source, self.station[0], url, self.url_fingerprint(url), self.sync_last_dates.pop(source, None),
+      counts['inserted'], counts['updated'], counts['skipped'], str(datetime.now())])
+    scraperwiki.sqlite.commit()
+    print 'Rows for %s for station %s: %s inserted, %s updated, %s skipped' % (source, self.station[0], counts['inserted'], counts['updated'], counts['skipped'])
 
-    scraperwiki.sql.save(keys, data, table_name = table)
+  # Make upsert query for a set of fields
+  def upsert_query(self, table, keys, fields):
+    query = 'INSERT INTO `%s` (%s) VALUES (%s) ON CONFLICT (%s) DO ' % (table,
+      ', '.join('`%s`' % f for f in fields), ', '.join('?' for f in fields),
+      ', '.join('`%s`' % k for k in keys))
+
+    updates = ['`%s` = excluded.`%s`' % (f, f) for f in fields if f not in keys]
+    if len(updates) == 0:
+      return query + 'NOTHING'
+
+    return query + 'UPDATE SET ' + ', '.join(updates)
 
 
 
@@ -181,76 +817,182 @@ class DailyWeatherScraper:
   # measurement
   def process_ghcn(self):
     print 'Reading GHCN file for station: %s (Recent: %s)' % (self.station[0], self.isRecent)
-    file_lines = self.read_url(self.ghcn_url_template % { 'ghcn_station': self.station[0] })
-    line_offset = 21
-
-    # Read in each line
+    file = self.read_url(self.ghcn_url(), False)
+    if file is None:
+      return
+    if self.file_unchanged('ghcn', self.ghcn_url()):
+      file.close()
+      return
+
+    # Read in each line.  Check if we are in the recent, as this will
+    # make things quicker with less db updates
     print 'Parsing GHCN file for station: %s' % self.station[0]
-    for line in file_lines:
-      # Parse out the month level data
-      month_data = {}
-      month_data['source'] = 'ghcn'
-      month_data['station'] = line[0:11].strip()
-      month_data['year'] = self.read_number_value(line[11:15])
-      month_data['month'] = self.read_number_value(line[15:17])
+    self.save_ghcn(self.read_ghcn(file, self.recent if self.isRecent else None))
+    file.close()
+    self.save_sync_state('ghcn', self.ghcn_url())
+    print 'Done parsing GHCN file for station: %s' % self.station[0]
+
+  # Save GHCN values to the GHCN table as one row for each
+  # day with all of its measurements.  The lines for a month are next to
+  # each other, so days are put together a month at a time.
+  def save_ghcn(self, values):
+    days = OrderedDict()
+    month = None
+
+    for value in values:
+      if (value.station, value.year, value.month) != month:
+        self.save_ghcn_days(days.values())
+        days = OrderedDict()
+        month = (value.station, value.year, value.month)
+
+      data = days.get(value.day)
+      if data is None:
+        data = {
+          'source': 'ghcn',
+          'station': value.station,
+          'year': value.year,
+          'month': value.month,
+          'day': value.day,
+          'date': self.make_date(value.year, value.month, value.day)
+        }
+        days[value.day] = data
+
+      data[value.element] = value.value
+      data[value.element + '_f'] = self.ghcn_flags_json(value.flags)
+
+    self.save_ghcn_days(days.values())
+    self.flush_data()
+
+  def save_ghcn_days(self, rows):
+    for data in rows:
+      self.update_data(data, ['station', 'year', 'month', 'day'], 'ghcn')
+
+  # Convert the three flag characters of a value to something more
+  # friendly, as JSON.  There are only a few combinations, so they are
+  # kept once made.
+  def ghcn_flags_json(self, packed):
+    if packed not in self.ghcn_flags:
+      flags = {}
+      if packed[0:1] != ' ':
+        flags['m'] = packed[0:1]
+      if packed[1:2] != ' ':
+        flags['q'] = packed[1:2]
+      if packed[2:3] != ' ':
+        flags['s'] = packed[2:3]
+      self.ghcn_flags[packed] = json.dumps(flags) if len(flags.keys()) > 0 else None
+
+    return self.ghcn_flags[packed]
+
+  # Read GHCN lines from an open file (or a local path) and yield a
+  # GhcnValue for each value.  This goes a line at a time so the file is
+  # never fully in memory.
+  def read_ghcn(self, file, since = None):
+    if isinstance(file, basestring):
+      file = open(file, 'rb')
+
+    # Lines are in year and month order, so skip anything before the month
+    # we want by the header alone, and jump ahead if we can
+    since_month = '%04d%02d' % (since.year, since.month) if since is not None else None
+    if since_month is not None:
+      self.seek_ghcn(file, since_month)
+
+    # Values are collected and converted in chunks
+    parsed = []
+    elements = []
+    values = []
+
+    for line in file:
+      if since_month is not None and line[11:17] < since_month:
+        continue
+
       element = line[17:21].strip().lower()
-      element_flags = element + '_f'
 
       # Only do specific measurements
       if element not in self.ghcn_measurements:
         continue
 
-      # Look for up to 31 values
-      for d in range(0, 31):
-        segment = line[line_offset + (d * 8):line_offset + (d * 8) + 8]
-        if segment is not None and segment.strip() != '':
-          # Make day data
-          data = month_data.copy()
-          data[element_flags] = {}
+      # Parse out the month level data
+      station = line[0:11].strip()
+      year = self.read_number_value(line[11:15])
+      month = self.read_number_value(line[15:17])
 
-          # Value
-          data[element] = self.read_number_value(segment[0:5], [-9999])
+      # Days before the one we want in its month
+      skip_days = since.day - 1 if since_month is not None and line[11:17] == since_month else 0
 
-          # Ensure that we have a valid number
-          if data[element] is not None:
-            # Make date
-            data['day'] = d + 1
-            data['date'] = dateutil.parser.parse('%s-%s-%s' % (data['year'], data['month'], data['day'])).date()
-
-            # Check if we are in the recent, as this will make things
-            # quicker with less db updates
-            if self.isRecent and data['date'] < self.recent:
-              continue
-
-            # Flags
-            if segment[5:6] != ' ':
-              data[element_flags]['m'] = segment[5:6]
-            if segment[6:7] != ' ':
-              data[element_flags]['q'] = segment[6:7]
-            if segment[7:8] != ' ':
-              data[element_flags]['s'] = segment[7:8]
-
-            # Convert flags to something more friendly
-            if len(data[element_flags].keys()) > 0:
-              data[element_flags] = json.dumps(data[element_flags])
-            else:
-              data[element_flags] = None
-
-            # Adjust measurements.  The metric system is better, but unfortunately we
-            # will be displaying in US, so might as well do it now
-            data[element] = float(data[element])
-            if element in ['tmax', 'tmin']:
-              data[element] = round(self.to_fahrenheit(data[element] / 10), 2)
-            if element in ['prcp']:
-              data[element] = round(self.to_inches_from_mm(data[element] / 10), 2)
-            if element in ['snow', 'snwd']:
-              data[element] = round(self.to_inches_from_mm(data[element]), 2)
-
-            # Save to GHCN and observations tables
-            self.update_data(data, ['station', 'year', 'month', 'day'], 'ghcn')
-            self.update_data(data, ['station', 'year', 'month', 'day'], 'observations')
+      # Look for up to 31 values
+      for d, (value_start, value_end) in enumerate(self.ghcn_day_columns):
+        if d < skip_days:
+          continue
+
+        # Ensure that we have a valid number
+        value = self.read_number_value(line[value_start:value_end], [-9999])
+        if value is None:
+          continue
+
+        # The flags follow the value
+        parsed.append((station, year, month, d + 1, element, line[value_end:value_end + 3]))
+        elements.append(element)
+        values.append(value)
+
+      if len(parsed) >= self.ghcn_chunk_size:
+        for value in self.convert_ghcn(parsed, elements, values):
+          yield value
+        parsed = []
+        elements = []
+        values = []
+
+    for value in self.convert_ghcn(parsed, elements, values):
+      yield value
+
+  # Adjust measurements for a chunk of parsed GHCN values, all at once,
+  # and make them into GhcnValues.  The metric system is better, but
+  # unfortunately we will be displaying in US, so might as well do it now.
+  # Rounding gives the same numbers as round() for every value GHCN can
+  # have.
+  def convert_ghcn(self, parsed, elements, values):
+    if len(parsed) == 0:
+      return []
+
+    elements = numpy.array(elements)
+    values = numpy.array(values, dtype = numpy.float64)
+    converted = numpy.empty(len(values))
+
+    temps = (elements == 'tmax') | (elements == 'tmin')
+    converted[temps] = self.to_fahrenheit(values[temps] / 10)
+    prcp = elements == 'prcp'
+    converted[prcp] = self.to_inches_from_mm(values[prcp] / 10)
+    snow = (elements == 'snow') | (elements == 'snwd')
+    converted[snow] = self.to_inches_from_mm(values[snow])
+    converted = numpy.round(converted, 2).tolist()
+
+    return [GhcnValue(p[0], p[1], p[2], p[3], p[4], converted[i], p[5]) for i, p in enumerate(parsed)]
+
+  # Move a local GHCN file to the first line of a month (as YYYYMM).  All
+  # lines are the same length, so we can binary search by line number;
+  # otherwise the file is left at the start.
+  def seek_ghcn(self, ghcn_file, month):
+    if not isinstance(ghcn_file, file):
+      return
+
+    start = ghcn_file.tell()
+    line_length = len(ghcn_file.readline())
+    ghcn_file.seek(0, 2)
+    size = ghcn_file.tell() - start
+    if line_length == 0 or size % line_length != 0:
+      ghcn_file.seek(start)
+      return
+
+    low = 0
+    high = size / line_length
+    while low < high:
+      middle = (low + high) / 2
+      ghcn_file.seek(start + (middle * line_length))
+      if ghcn_file.read(17)[11:17] < month:
+        low = middle + 1
+      else:
+        high = middle
 
-    print 'Done parsing GHCN file for station: %s' % self.station[0]
+    ghcn_file.seek(start + (low * line_length))
 
 
 
@@ -259,147 +1001,271 @@ class DailyWeatherScraper:
   # with each line as a month of days
   def process_normals(self):
     print 'Reading Normals file for station: %s' % self.station[0]
-    file_lines = self.read_url(self.normals_url_template % { 'ghcn_station': self.station[0], 'year': self.year })
-    line_offset = 20
+    file_lines = self.read_url(self.normals_url(), True, True)
 
     # Read in each line
     print 'Parsing Normals file for station: %s' % self.station[0]
-    for section in self.normals_measurements:
-      lines = self.read_normals_section(file_lines, section)
+    self.save_normals(self.read_normals(file_lines))
+    print 'Done parsing Normals file for station: %s' % self.station[0]
 
-      # Go through each line as month
-      for m, line in enumerate(lines):
-        # Month level data
-        month_data = {}
-        month_data['station'] = self.station[0]
-        month_data['month'] = m + 1
+  # Save normals data
+  def save_normals(self, rows):
+    for data in rows:
+      self.update_data(data, ['station', 'month', 'day'], 'normals')
 
-        # Keep track of previous so that we can make a day value for the
-        # month-to-date values
-        previous = None
+    self.flush_data()
 
-        # Get each day
-        for d in range(0, 31):
-          # Get each set of value and flag
-          segment = line[line_offset + (d * 7):line_offset + (d * 7) + 7]
-          if segment is not None and segment.strip() != '':
-              value = segment[0:5].strip()
-              flag = segment[5:6].strip()
-
-              # Only save when we have a valid value
-              if value != '' and value not in ['-9999', '-8888', '-6666', '-5555']:
-                value = 0 if value == '-7777' else value
-                value = self.read_number_value(value, [-9999])
-
-                # Alter data according to units
-                if section[2] == 'temp':
-                  value = value * 1.0 / 10
-                elif section[2] == 'precip':
-                  value = value * 1.0 / 100
-                elif section[2] == 'snow':
-                  value = value * 1.0 / 10
-
-                # Month to date values.  Subtract from previous origin
-                if section[2] in ['precip', 'snow']:
-                  orig = value
-                  value = round(value - previous, 2) if previous is not None else value
-                  previous = orig
-
-                # Start making data
-                data = month_data.copy()
-                data['day'] = d + 1
-                data[section[1]] = value
-                data[section[1] + '_f'] = flag if flag != '' else None
-
-                # Make fake date for easier querying
-                data['date'] = dateutil.parser.parse('%s-%s-%s' % ('2000', data['month'], data['day'])).date()
-
-                # Save data
-                self.update_data(data, ['station', 'month', 'day'], 'normals')
+  # Read the normals measurements we want from the lines of a normals file
+  # and yield one row for each day with all of its measurements
+  def read_normals(self, file_lines):
+    sections = self.index_normals_sections(file_lines)
+    days = {}
 
-    print 'Done parsing Normals file for station: %s' % self.station[0]
+    for section in self.normals_measurements:
+      if section[0] not in sections:
+        continue
 
-  # Read in section for specific normals measurement.
-  def read_normals_section(self, lines, section):
-    found = False
-    found_index = 0;
-    found_lines = []
+      start, end = sections[section[0]]
+      values, valid, flags = self.read_normals_values(file_lines[start:end])
+      values = self.convert_normals(values, valid, section[2]).tolist()
+
+      # Go through each line as month and add each day with a valid value
+      for m in range(0, end - start):
+        for d in range(0, 31):
+          if not valid[m][d]:
+            continue
+
+          data = days.get((m + 1, d + 1))
+          if data is None:
+            data = {}
+            data['station'] = self.station[0]
+            data['month'] = m + 1
+            data['day'] = d + 1
 
-    # Find section in what is probably a very inefficent way
-    for line in lines:
-      if line.startswith(section[0]):
-        found = True
+            # Make fake date for easier querying
+            data['date'] = self.normals_date(data['month'], data['day'])
+            days[(m + 1, d + 1)] = data
+
+          data[section[1]] = values[m][d]
+          data[section[1] + '_f'] = flags[m][d]
+
+    for key in sorted(days.keys()):
+      yield days[key]
+
+  # Find each section of a normals file in one pass, as keyword to (start,
+  # end) line numbers.  A section starts at the line beginning with its
+  # keyword (like dly-tmax-normal) and is the 12 months from there, or less
+  # if another section starts first.
+  def index_normals_sections(self, file_lines):
+    sections = {}
+    current = None
+
+    for i, line in enumerate(file_lines):
+      keyword = line.split(None, 1)[0] if line[:1].strip() != '' else None
+      if keyword is not None and self.normals_keyword.match(keyword) and keyword != current:
+        if current is not None:
+          sections[current] = (sections[current][0], min(sections[current][1], i))
+        current = None
+
+        # Only the first section with a keyword counts
+        if keyword not in sections:
+          current = keyword
+          sections[current] = (i, i + 12)
+
+    if current is not None:
+      sections[current] = (sections[current][0], min(sections[current][1], len(file_lines)))
+    return sections
+
+  # Read raw values and flags from the lines of a normals section, as month
+  # by day arrays of values and whether each day has a valid value, and a
+  # month by day list of flags
+  def read_normals_values(self, lines):
+    line_offset = 20
+    values = numpy.zeros((len(lines), 31))
+    valid = numpy.zeros((len(lines), 31), dtype = bool)
+    flags = []
 
-      if found and found_index < 12:
-        found_lines.append(line)
-        found_index = found_index + 1
+    for m, line in enumerate(lines):
+      flags.append([None] * 31)
 
-    return found_lines
+      for d in range(0, 31):
+        # Get each set of value and flag
+        segment = line[line_offset + (d * 7):line_offset + (d * 7) + 7]
+        if segment.strip() == '':
+          continue
+
+        value = segment[0:5].strip()
+        flag = segment[5:6].strip()
+
+        # Only save when we have a valid value.  -7777 is a value that
+        # rounds to zero
+        if value != '' and value not in ['-9999', '-8888', '-6666', '-5555']:
+          value = self.read_number_value('0' if value == '-7777' else value, [-9999])
+          if value is not None:
+            values[m][d] = value
+            valid[m][d] = True
+            flags[m][d] = flag if flag != '' else None
+
+    return values, valid, flags
+
+  # Alter a section's values according to units, all at once.  Month to
+  # date values become daily values by subtracting the previous valid day
+  # in the month; the first day is kept as is.
+  def convert_normals(self, values, valid, units):
+    if units == 'temp':
+      values = values * 1.0 / 10
+    elif units == 'precip':
+      values = values * 1.0 / 100
+    elif units == 'snow':
+      values = values * 1.0 / 10
+
+    if units in ['precip', 'snow']:
+      for m in range(0, len(values)):
+        days = numpy.nonzero(valid[m])[0]
+        if len(days) > 1:
+          values[m][days[1:]] = numpy.round(values[m][days[1:]] - values[m][days[:-1]], 2)
+
+    return values
 
 
 
   # Process GSOD data.  Each line is a day.  We only want recent data
   # but we still may need multiple files
   def process_gsod(self):
-    # Determine years
-    years = [self.year] if self.year == self.recent_year else [self.year, self.recent_year]
-    for year in years:
+    for year in self.gsod_years():
 
       print 'Reading GSOD file for station: %s and year: %s' % (self.station[1], year)
-      file_lines = self.read_url(self.gsod_url_template % { 'gsod_station': self.station[1], 'year': year })
+      file = self.read_url(self.gsod_url(year), False)
+      if file is None:
+        continue
+      if self.file_unchanged('gsod', self.gsod_url(year)):
+        file.close()
+        continue
 
-      # Read in each line
+      # Read in each line as it is decompressed
       print 'Parsing GSOD file for station: %s and year: %s' % (self.station[1], year)
-      for line in file_lines:
-        # Make data
-        data = {}
-        data['source'] = 'gsod'
-        data['station'] = self.station[0]
-        data['gsod_station'] = self.station[1]
-
-        # Only update if the line has a number
-        if self.is_number(line[0]):
-          #data['station'] = line[0:6].strip()
-          data['wban'] = line[7:12].strip()
-          data['year'] = self.read_number_value(line[14:18])
-          data['month'] = self.read_number_value(line[18:20])
-          data['day'] = self.read_number_value(line[20:22])
-          data['tavg'] = self.read_number_value(line[24:30], [9999.9])
-          #data['temp_count'] = read_number_value(line[31:33])
-          #data['dew'] = read_number_value(line[35:41], 9999.9)
-          #data['dew_count'] = read_number_value(line[42:44])
-          #data['slp'] = read_number_value(line[46:51], 9999.9)
-          #data['slp_count'] = read_number_value(line[53:54])
-          #data['stp'] = read_number_value(line[57:63], 9999.9)
-          #data['stp_count'] = read_number_value(line[64:66])
-          #data['visibility'] = read_number_value(line[68:73], 999.9)
-          #data['visibility_count'] = read_number_value(line[74:76])
-          #data['wind'] = read_number_value(line[78:83], 999.9)
-          #data['wind_count'] = read_number_value(line[84:86])
-          #data['wind_max'] = read_number_value(line[88:93], 999.9)
-          #data['wind_gust'] = read_number_value(line[85:100], 999.9)
-          data['tmax'] = self.read_number_value(line[102:108], [9999.9])
-          #data['temp_max_hourly'] = read_binary_value(line[108:109])
-          data['tmin'] = self.read_number_value(line[110:116], [9999.9])
-          #data['temp_min_hourly'] = read_binary_value(line[116:117])
-          data['prcp'] = self.read_number_value(line[118:123], [99.9])
-          data['prcp_f'] = line[123:124].strip()
-          data['snwd'] = self.read_number_value(line[125:130], [999.9])
-          #data['fog'] = read_binary_value(line[132:133])
-          #data['rain'] = read_binary_value(line[133:134])
-          #data['snow'] = read_binary_value(line[134:135])
-          #data['hail'] = read_binary_value(line[135:136])
-          #data['thunder'] = read_binary_value(line[136:137])
-          #data['tornado'] = read_binary_value(line[137:138])
-          data['date'] = dateutil.parser.parse('%s-%s-%s' % (data['year'], data['month'], data['day'])).date()
-
-          # Save the data to a gsod table and non-destructively add to observations
-          if self.isRecent and data['date'] >= self.recent:
-            self.update_data(data, ['station', 'year', 'month', 'day'], 'gsod')
-            self.update_data(data, ['station', 'year', 'month', 'day'], 'observations', True)
-
+      self.save_gsod(data for data in self.read_gsod(file) if self.isRecent and data['date'] >= self.recent)
+      file.close()
+      self.save_sync_state('gsod', self.gsod_url(year))
       print 'Done parsing GSOD file for station: %s and year: %s' % (self.station[1], year)
 
+  # Save GSOD data to the GSOD table
+  def save_gsod(self, rows):
+    for data in rows:
+      self.update_data(data, ['station', 'year', 'month', 'day'], 'gsod')
+
+    self.flush_data()
+
+  # Read GSOD lines for the current station and yield the data for each day
+  def read_gsod(self, file):
+    for line in file:
+      # Make data
+      data = {}
+      data['source'] = 'gsod'
+      data['station'] = self.station[0]
+      data['gsod_station'] = self.station[1]
+
+      # Only update if the line has a number
+      if self.is_number(line[0]):
+        #data['station'] = line[0:6].strip()
+        data['wban'] = line[7:12].strip()
+        data['year'] = self.read_number_value(line[14:18])
+        data['month'] = self.read_number_value(line[18:20])
+        data['day'] = self.read_number_value(line[20:22])
+        data['tavg'] = self.read_number_value(line[24:30], [9999.9])
+        #data['temp_count'] = read_number_value(line[31:33])
+        #data['dew'] = read_number_value(line[35:41], 9999.9)
+        #data['dew_count'] = read_number_value(line[42:44])
+        #data['slp'] = read_number_value(line[46:51], 9999.9)
+        #data['slp_count'] = read_number_value(line[53:54])
+        #data['stp'] = read_number_value(line[57:63], 9999.9)
+        #data['stp_count'] = read_number_value(line[64:66])
+        #data['visibility'] = read_number_value(line[68:73], 999.9)
+        #data['visibility_count'] = read_number_value(line[74:76])
+        #data['wind'] = read_number_value(line[78:83], 999.9)
+        #data['wind_count'] = read_number_value(line[84:86])
+        #data['wind_max'] = read_number_value(line[88:93], 999.9)
+        #data['wind_gust'] = read_number_value(line[85:100], 999.9)
+        data['tmax'] = self.read_number_value(line[102:108], [9999.9])
+        #data['temp_max_hourly'] = read_binary_value(line[108:109])
+        data['tmin'] = self.read_number_value(line[110:116], [9999.9])
+        #data['temp_min_hourly'] = read_binary_value(line[116:117])
+        data['prcp'] = self.read_number_value(line[118:123], [99.9])
+        data['prcp_f'] = line[123:124].strip()
+        data['snwd'] = self.read_number_value(line[125:130], [999.9])
+        #data['fog'] = read_binary_value(line[132:133])
+        #data['rain'] = read_binary_value(line[133:134])
+        #data['snow'] = read_binary_value(line[134:135])
+        #data['hail'] = read_binary_value(line[135:136])
+        #data['thunder'] = read_binary_value(line[136:137])
+        #data['tornado'] = read_binary_value(line[137:138])
+        data['date'] = self.make_date(data['year'], data['month'], data['day'])
+
+        yield data
+
+
+
+  # The pages we read are only used for one block of text or one table,
+  # so those are found with regular expressions over the known layouts.
+  # If a page does not look like we expect, the whole page is parsed with
+  # BeautifulSoup like it always was.
+
+  # Attributes of a tag as a dict with lowercase names
+  def html_attributes(self, attributes):
+    return dict((m.group(1).lower(), m.group(2) if m.group(2) is not None else m.group(3) if m.group(3) is not None else m.group(4))
+      for m in self.html_attribute.finditer(attributes))
+
+  # Text at the start of the first tag with the given attributes, same
+  # as html(tag, **attributes)[0].contents[0] with BeautifulSoup
+  def html_text(self, page, tag, **attributes):
+    for m in self.html_tag.finditer(page):
+      if m.group(1) == '' and m.group(2).lower() == tag:
+        found = self.html_attributes(m.group(3))
+        if len([a for a, v in attributes.items() if found.get(a) != v]) == 0:
+          end = page.find('<', m.end())
+          text = page[m.end():end if end >= 0 else len(page)]
+          if text.strip() != '':
+            return text
+          break
+
+    print 'Parsing whole page to find %s tag' % tag
+    found = BeautifulSoup(page)(tag, **attributes)
+    return found[0].contents[0] if len(found) > 0 else None
+
+  # Cells of each row of the first table with the given attributes, as
+  # lists of strings, or None for empty cells
+  def html_table_cells(self, page, **attributes):
+    rows = None
+    row = None
+    cell = None
+
+    for m in self.html_tag.finditer(page):
+      closing, tag = m.group(1) == '/', m.group(2).lower()
+      if rows is None:
+        if tag == 'table' and not closing and len([a for a, v in attributes.items() if self.html_attributes(m.group(3)).get(a) != v]) == 0:
+          rows = []
+        continue
+
+      # Cell text is whatever is between its tags, without other tags
+      if cell is not None and tag in ['td', 'tr', 'table']:
+        text = re.sub(r'<[^>]*>', '', page[cell:m.start()]).strip()
+        row.append(text if text != '' else None)
+        cell = None
+
+      if tag == 'table':
+        break
+      elif tag == 'tr' and not closing:
+        row = []
+        rows.append(row)
+      elif tag == 'td' and not closing and row is not None:
+        cell = m.end()
+
+    if rows is not None and len([r for r in rows if len(r) > 0]) > 0:
+      return rows
+
+    print 'Parsing whole page to find table'
+    table = BeautifulSoup(page).find('table', **attributes)
+    return [[c.string for c in r.findAll('td')] for r in table.findAll('tr')]
 
 
   # Process U of M Climate data.  It is an HTML document with each line
@@ -408,12 +1274,11 @@ class DailyWeatherScraper:
     # Read in each decade
     for decade in self.mn_decades:
       print 'Reading U of M Climate file for decade: %s' % decade
-      file = self.read_url(self.mn_url_template % { 'mn_decade': decade }, True)
-      html = BeautifulSoup(''.join(file))
+      file = self.read_url(self.mn_url(decade), True, True)
 
       # Get the text from the page
       print 'Parsing U of M Climate file for decade: %s' % decade
-      text = html('font', face = 'Courier New')[0].contents[0]
+      text = self.html_text(''.join(file), 'font', face = 'Courier New')
       lines = text.split('\r\n')
       for l in lines:
         # Aw, the joys of scraping.  Things are /t delimited, well, except for
@@ -435,12 +1300,12 @@ class DailyWeatherScraper:
           data['prcp'] = self.read_mn_climate_value(line[5])
           data['snow'] = self.read_mn_climate_value(line[6])
           data['snwd'] = self.read_mn_climate_value(line[7])
-          data['date'] = dateutil.parser.parse('%s-%s-%s' % (data['year'], data['month'], data['day'])).date()
+          data['date'] = self.make_date(data['year'], data['month'], data['day'])
 
-          # Save data to mn_climates table and non-destructively to observations
+          # Save data to mn_climates table
           self.update_data(data, ['station', 'year', 'month', 'day'], 'mn_climate')
-          self.update_data(data, ['station', 'year', 'month', 'day'], 'observations', True)
 
+      self.flush_data()
       print 'Done parsing U of M Climate file for decade: %s' % decade
 
 
@@ -462,31 +1327,26 @@ class DailyWeatherScraper:
   def process_nws_monthly(self):
     section_starter = '============================='
 
-    # We need to determine what months are needed, then get the last date of
-    # that month :(
-    last_month_days = []
-    last_month_days.append(self.last_day_of_month(self.date))
-    if self.recent.month != self.date.month:
-      last_month_days.append(self.last_day_of_month(self.recent))
-
-    # Go through each last day and read in file
-    for last_day in last_month_days:
+    # Go through each last day of the months we need and read in file
+    for last_day in self.nws_monthly_days():
       print 'Reading NWS monthly data for %s-%s for station: %s,%s' % (last_day.year, last_day.month, self.station[3], self.station[4])
-      url_date = '%s-%s-%s' % (last_day.year, last_day.month, last_day.day)
-      url = self.nws_monthly_url_template % { 'wfo_id': self.station[3], 'sid_id': self.station[4], 'end_month_date': url_date }
-      file = self.read_url(url, True)
-      html = BeautifulSoup(''.join(file))
+      file = self.read_url(self.nws_monthly_url(last_day), True)
+      if self.file_unchanged('nws', self.nws_monthly_url(last_day)):
+        continue
+      page = ''.join(file)
 
       # Get the text from the HTML
       print 'Parsing NWS monthly data for %s-%s for station: %s,%s' % (last_day.year, last_day.month, self.station[3], self.station[4])
 
       # Ensure that there is data
-      if len(html('h2')) > 0 and 'no records' in html('h2')[0].contents[0]:
+      heading = re.search(r'<h2\b[^>]*>([^<]*)', page, re.I)
+      if heading is not None and 'no records' in heading.group(1):
         print 'No data found in NWS monthly data for %s-%s for station: %s,%s' % (last_day.year, last_day.month, self.station[3], self.station[4])
+        self.flush_data()
         return
 
       # Parse valid data
-      text = html('font', size = '3')[0].contents[0]
+      text = self.html_text(page, 'font', size = '3')
       lines = text.split('\n')
       section_counter = 0
 
@@ -511,11 +1371,13 @@ class DailyWeatherScraper:
           data['prcp'] = self.read_mn_climate_value(l[26:31].strip())
           data['snow'] = self.read_mn_climate_value(l[31:36].strip())
           data['snwd'] = self.read_mn_climate_value(l[36:41].strip())
-          data['date'] = dateutil.parser.parse('%s-%s-%s' % (data['year'], data['month'], data['day'])).date()
+          data['date'] = self.make_date(data['year'], data['month'], data['day'])
 
-          # Save data to own table and observations
+          # Save data to own table
           self.update_data(data, ['station', 'year', 'month', 'day'], 'nws')
-          self.update_data(data, ['station', 'year', 'month', 'day'], 'observations', True)
+
+      self.flush_data()
+      self.save_sync_state('nws', self.nws_monthly_url(last_day))
 
 
 
@@ -526,9 +1388,9 @@ class DailyWeatherScraper:
   # Process out the 3 day report from the National Weather Service
   def process_nws_recent(self):
     print 'Reading NWS recent data for station: %s' % (self.station[2])
-    file = self.read_url(self.nws_recent_url_template % { 'airport_id': self.station[2] }, True)
-    html = BeautifulSoup(''.join(file))
-
+    file = self.read_url(self.nws_recent_url(), True)
+    if self.file_unchanged('nws_recent', self.nws_recent_url()):
+      return
     # Set up data to save and amounts to check
     total_temp = []
     data = {}
@@ -538,41 +1400,38 @@ class DailyWeatherScraper:
     data['year'] = self.today.year
     data['month'] = self.today.month
     data['day'] = self.today.day
-    data['date'] = dateutil.parser.parse('%s-%s-%s' % (data['year'], data['month'], data['day'])).date()
+    data['date'] = self.make_date(data['year'], data['month'], data['day'])
     data['tmin'] = 999999
     data['tmax'] = -999999
     data['prcp'] = 0
 
     # Parse the HTML and find the relevant data
     print 'Parsing NWS recent data for station: %s' % (self.station[2])
-    table = html.find('table', cellspacing = '3', cellpadding = '2', border = '0', width = '670')
-    rows = table.findAll('tr')
-    for r in rows:
-      cols = r.findAll('td')
-
-      # Find entries that are numbers and the same as today's date
-      if len(cols) > 15 and cols[0].string is not None and self.is_number(cols[0].string) and self.parse_num(cols[0].string) == self.today.day:
+    rows = self.html_table_cells(''.join(file), cellspacing = '3', cellpadding = '2', border = '0', width = '670')
+    for cols in rows:
+      # Find entries that are the same as today's date
+      if len(cols) > 15 and self.parse_num(cols[0]) == self.today.day:
         # Add total temp
-        temp = self.parse_num(cols[6].string)
+        temp = self.parse_num(cols[6])
         if temp is not None:
           total_temp.append(temp)
 
         # Maximum
-        tmax = self.parse_num(cols[8].string)
+        tmax = self.parse_num(cols[8])
         if tmax is not None:
           data['tmax'] = tmax if tmax > data['tmax'] else data['tmax']
         elif temp is not None:
           data['tmax'] = temp if temp > data['tmax'] else data['tmax']
 
         # Minimum
-        tmin = self.parse_num(cols[9].string)
+        tmin = self.parse_num(cols[9])
         if tmin is not None:
           data['tmin'] = tmin if tmin < data['tmin'] else data['tmin']
         elif temp is not None:
           data['tmin'] = temp if temp < data['tmin'] else data['tmin']
 
         # Precipitation
-        prcp = self.parse_num(cols[15].string)
+        prcp = self.parse_num(cols[15])
         if prcp is not None:
           data['prcp'] = data['prcp'] + prcp
 
@@ -581,37 +1440,673 @@ class DailyWeatherScraper:
     if len(total_temp) > 0:
       data['tavg'] = (sum(total_temp) * 1.0)/len(total_temp)
 
-      # Save to observations and nws recent
+      # Save to nws recent
       self.update_data(data, ['station', 'year', 'month', 'day'], 'nws_recent')
-      self.update_data(data, ['station', 'year', 'month', 'day'], 'observations', True)
+      self.flush_data()
+      self.save_sync_state('nws_recent', self.nws_recent_url())
+
+
+
+  # Rebuild observations from the source tables for every day on or after a
+  # date (or all of them), in one query.  Each value is the first one found
+  # going through observation_sources, or for observation_groups, from the
+  # first source with any value in the group.  Flags come from the same
+  # source as their value.  The source of a day is the first source that
+  # has it, and observation_station_columns only come from that source.
+  def merge_observations(self, since = None):
+    print 'Merging observations since: %s' % (since or 'the beginning')
+    keys, columns, indexes = self.schema['observations']
+    sources = [(s, [c for c, t in self.schema[s][1]]) for s in self.observation_sources]
+    match = ' AND '.join('`%%(source)s`.`%s` = k.`%s`' % (k, k) for k in keys)
+
+    # The first source where a condition holds, as a CASE that picks that
+    # source's value of a column, or NULL if it doesn't have the column
+    def first_source(condition, c):
+      found = ['WHEN %s THEN %s' % (condition(s, cs), '`%s`.`%s`' % (s, c) if c in cs else 'NULL') for s, cs in sources if condition(s, cs)]
+      return 'CASE %s END' % ' '.join(found) if len(found) > 0 else 'NULL'
+
+    values = []
+    for c, t in columns:
+      value = c[:-2] if c.endswith('_f') else c
+      group = [g for g in self.observation_groups if value in g]
+      if c in keys or c == 'date':
+        values.append('k.`%s`' % c)
+      elif c == 'source':
+        values.append('CASE %s END' % ' '.join("WHEN `%s`.`station` IS NOT NULL THEN '%s'" % (s, s) for s, cs in sources))
+      elif c in self.observation_station_columns:
+        values.append(first_source(lambda s, cs: '`%s`.`station` IS NOT NULL' % s, c))
+      elif len(group) > 0:
+        values.append(first_source(lambda s, cs: ' OR '.join('`%s`.`%s` IS NOT NULL' % (s, g) for g in group[0] if g in cs), c))
+      elif c.endswith('_f'):
+        values.append(first_source(lambda s, cs: value in cs and '`%s`.`%s` IS NOT NULL' % (s, value), c))
+      else:
+        found = ['`%s`.`%s`' % (s, c) for s, cs in sources if c in cs]
+        values.append('COALESCE(%s)' % ', '.join(found) if len(found) > 1 else found[0] if len(found) > 0 else 'NULL')
+
+    query = 'INSERT OR REPLACE INTO observations (%s) SELECT %s FROM (%s) AS k %s' % (
+      ', '.join('`%s`' % c for c, t in columns), ', '.join(values),
+      ' UNION '.join('SELECT %s, `date` FROM `%s` WHERE `date` >= ?' % (', '.join('`%s`' % k for k in keys), s) for s, cs in sources),
+      ' '.join('LEFT JOIN `%s` ON %s' % (s, match % { 'source': s }) for s, cs in sources))
+    scraperwiki.sqlite.dt.execute(query, [str(since or date.min)] * len(sources), commit = False)
+    scraperwiki.sqlite.commit()
+
+  # Compare each pair of observation sources on the days they both have,
+  # for every day on or after a date (or all of them), and keep the
+  # measurements that differ by more than their threshold.  Each pair and
+  # measurement is one query joining on the sources' unique keys.  Prints a
+  # summary of what was found.
+  def validate_sources(self, since = None):
+    print 'Comparing sources since: %s' % (since or 'the beginning')
+    start = str(since or date.min)
+    scraperwiki.sqlite.dt.execute('DELETE FROM discrepancies WHERE date >= ?', [start], commit = False)
+
+    for i, source in enumerate(self.observation_sources):
+      columns = [c for c, t in self.schema[source][1]]
+      for other in self.observation_sources[i + 1:]:
+        other_columns = [c for c, t in self.schema[other][1]]
+        for measurement, threshold in self.discrepancy_thresholds.items():
+          if measurement not in columns or measurement not in other_columns:
+            continue
+
+          scraperwiki.sqlite.dt.execute('''
+            INSERT OR REPLACE INTO discrepancies
+              (station, year, month, day, date, measurement, source, value, other_source, other_value, difference)
+            SELECT a.station, a.year, a.month, a.day, a.date, '%(measurement)s', '%(source)s', a.`%(measurement)s`,
+              '%(other)s', b.`%(measurement)s`, ROUND(a.`%(measurement)s` - b.`%(measurement)s`, 2)
+            FROM `%(source)s` AS a
+              INNER JOIN `%(other)s` AS b ON
+                a.station = b.station AND a.year = b.year AND a.month = b.month AND a.day = b.day
+            WHERE a.date >= ? AND ABS(a.`%(measurement)s` - b.`%(measurement)s`) > ?
+          ''' % { 'source': source, 'other': other, 'measurement': measurement }, [start, threshold], commit = False)
+
+    scraperwiki.sqlite.commit()
+
+    found = scraperwiki.sqlite.execute('''SELECT source, other_source, measurement, COUNT(*), ROUND(AVG(ABS(difference)), 2), MAX(ABS(difference))
+      FROM discrepancies WHERE date >= ? GROUP BY source, other_source, measurement''', [start])
+    for source, other, measurement, count, average, largest in found['data']:
+      print 'Discrepancies between %s and %s for %s: %s days, %s apart on average, at most %s' % (source, other, measurement, count, average, largest)
+      self.count('discrepancies', count)
+
+  # Rebuild the records for each day of the year from observations, for
+  # every station and day of the year that has observations on or after a
+  # date (or all of them).  Records go to the earliest year that had them.
+  def refresh_day_records(self, since = None):
+    # A table that was just made, as when upgrading a database from before
+    # there were records, is filled from all observations
+    if since and self.table_empty('day_records'):
+      since = None
+
+    print 'Refreshing day of year records since: %s' % (since or 'the beginning')
+    where = '' if since is None else 'WHERE (station, month, day) IN (SELECT DISTINCT station, month, day FROM observations WHERE date >= ?)'
+    params = [] if since is None else [str(since)]
+
+    # Read with a cursor of its own so that writing doesn't stop it
+    cursor = scraperwiki.sqlite.dt.connection.cursor()
+    cursor.execute('SELECT station, month, day, year, %s FROM observations %s ORDER BY station, month, day' % (
+      ', '.join(self.record_measurements), where), params)
+
+    for (station, month, day), rows in groupby(cursor, lambda r: r[0:3]):
+      rows = list(rows)
+      scraperwiki.sqlite.dt.execute('DELETE FROM day_records WHERE station = ? AND month = ? AND day = ?', [station, month, day], commit = False)
+      records = [self.day_record(station, month, day, m, [(r[4 + i], r[3]) for r in rows if r[4 + i] is not None])
+        for i, m in enumerate(self.record_measurements)]
+      scraperwiki.sqlite.dt.cursor.executemany('INSERT INTO day_records VALUES (%s)' % ', '.join(['?'] * 16), [r for r in records if r is not None])
+
+    scraperwiki.sqlite.commit()
+
+  # Make a day_records row from a list of (value, year) pairs
+  def day_record(self, station, month, day, measurement, values):
+    if len(values) == 0:
+      return None
 
+    sorted_values = sorted(v for v, y in values)
+    high = sorted_values[-1]
+    low = sorted_values[0]
+    percentiles = numpy.round(numpy.percentile(sorted_values, [10, 25, 50, 75, 90]), 2).tolist()
+
+    return [station, month, day, measurement, len(values),
+      high, min(y for v, y in values if v == high), low, min(y for v, y in values if v == low),
+      round(sum(sorted_values) / len(sorted_values), 2)] + percentiles + [json.dumps(sorted_values)]
+
+  # Where a value would rank among the values for a station and day of
+  # the year, as the number of values below it, the number of values and
+  # the percent below it, or None if there are none
+  def day_rank(self, station, month, day, measurement, value):
+    found = scraperwiki.sqlite.execute('SELECT sorted_values FROM day_records WHERE station = ? AND month = ? AND day = ? AND measurement = ?',
+      [station, month, day, measurement])
+    if len(found['data']) == 0:
+      return None
+
+    sorted_values = json.loads(found['data'][0][0])
+    below = bisect.bisect_left(sorted_values, value)
+    return (below, len(sorted_values), round(below * 100.0 / len(sorted_values), 2))
+
+  # Whether a table has no rows, as when migrate_schema has just made it
+  def table_empty(self, table):
+    return scraperwiki.sqlite.execute('SELECT EXISTS (SELECT 1 FROM `%s`)' % table)['data'][0][0] == 0
+
+  # Rebuild the daily summary from observations and normals for every day
+  # on or after a date (or all of them), then the monthly and yearly
+  # rollups that those days are in.  This is all done in the database.
+  # Average temperature is the same as what the dashboard used to work out
+  # itself: the observed average, or else the middle of the high and low.
+  def refresh_summaries(self, since = None):
+    # Tables that were just made, as when upgrading a database from before
+    # there were summaries, are filled from the beginning
+    if since and any(self.table_empty(t) for t in ['daily_summary', 'monthly_summary', 'yearly_summary']):
+      since = None
+
+    print 'Refreshing summaries since: %s' % (since or 'the beginning')
+    scraperwiki.sqlite.dt.execute('''
+      INSERT OR REPLACE INTO daily_summary
+        (station, source, year, month, day, date, tmax, tmin, tavg, prcp, snow, snwd,
+        ntmax, ntmin, ntavg, nprcp, nsnow,
+        tmax_departure, tmin_departure, tavg_departure, prcp_departure, snow_departure)
+      SELECT s.*,
+        ROUND(s.tmax - s.ntmax, 2), ROUND(s.tmin - s.ntmin, 2), ROUND(s.tavg - s.ntavg, 2),
+        ROUND(s.prcp - s.nprcp, 2), ROUND(s.snow - s.nsnow, 2)
+      FROM (
+        SELECT o.station, o.source, o.year, o.month, o.day, o.date, o.tmax, o.tmin,
+          CASE WHEN o.tavg IS NULL THEN ROUND((o.tmax + o.tmin) / 2, 2) ELSE o.tavg END AS tavg,
+          o.prcp, o.snow, o.snwd, n.ntmax, n.ntmin, n.ntavg, n.nprcp, n.nsnow
+        FROM observations AS o
+          LEFT JOIN normals AS n ON
+            o.station = n.station AND o.month = n.month AND o.day = n.day
+        WHERE o.date >= ?
+      ) AS s
+    ''', [str(since or date.min)], commit = False)
+
+    # Rollups are rebuilt for whole months and years
+    for table, keys, start in [
+      ('monthly_summary', ['station', 'year', 'month'], date(since.year, since.month, 1) if since else date.min),
+      ('yearly_summary', ['station', 'year'], date(since.year, 1, 1) if since else date.min)]:
+      scraperwiki.sqlite.dt.execute('INSERT OR REPLACE INTO %s (%s) SELECT %s FROM daily_summary WHERE date >= ? GROUP BY %s' % (table,
+        ', '.join(keys + [c for c, t, a in self.rollup_columns]),
+        ', '.join(keys + [a for c, t, a in self.rollup_columns]),
+        ', '.join(keys)), [str(start)], commit = False)
+
+    scraperwiki.sqlite.commit()
+
+  # Write static files of the daily summary for each station: the recent
+  # days, each year on or after a date (or all of them) and the records
+  # for each day of the year.  Days are written as gzipped JSON and as
+  # columns of binary floats (see pack_columns)
+  def export_summaries(self, since = None):
+    if not self.export_dir:
+      return
+
+    for s in self.stations:
+      self.station = s
+      print 'Exporting summaries for station: %s' % self.station[0]
+      self.export_days('recent', 'date > ? AND date <= ?', [str(self.recent), str(self.today)])
+
+      # A station without year files yet, as when upgrading from before
+      # there were exports, gets all of its years
+      directory = os.path.join(self.export_dir, self.station[0])
+      exported = os.path.isdir(directory) and any(re.match(r'^\d{4}\.json\.gz$', f) for f in os.listdir(directory))
+
+      years = scraperwiki.sqlite.execute('SELECT DISTINCT year FROM daily_summary WHERE station = ? AND date >= ?',
+        [self.station[0], str(since if since and exported else date.min)])
+      for year in years['data']:
+        self.export_days(str(year[0]), 'year = ?', [year[0]])
+
+      self.write_export('records.json.gz', self.day_of_year_records())
+
+  # Export the days of the current station that match a where clause
+  def export_days(self, name, where, params):
+    rows = scraperwiki.sqlite.execute('SELECT %s, julianday(date) - 2440587.5 FROM daily_summary WHERE station = ? AND %s ORDER BY date' % (
+      ', '.join(self.export_columns), where), [self.station[0]] + params)
+
+    self.write_export(name + '.json.gz', [dict(zip(self.export_columns, r[:-1])) for r in rows['data']])
+    self.write_export(name + '.bin', self.pack_columns(['days'] + self.export_columns[1:],
+      [[r[-1]] + list(r[1:-1]) for r in rows['data']]))
+
+  # Highest or lowest value of each record measurement for each day of the
+  # year, and the year it happened, for the current station
+  def day_of_year_records(self):
+    records = {}
+    for field, pick in self.export_records:
+      rows = scraperwiki.sqlite.execute('SELECT month, day, %s FROM day_records WHERE station = ? AND measurement = ?' % (
+        'high, high_year' if pick == 'MAX' else 'low, low_year'), [self.station[0], field])
+      for month, day, value, year in rows['data']:
+        record = records.setdefault((month, day), OrderedDict([('month', month), ('day', day)]))
+        record[field] = value
+        record[field + '_year'] = year
+
+    return [records[k] for k in sorted(records.keys())]
+
+  # Pack rows into a binary file of columns.  It starts with the length
+  # of a JSON header, as a little-endian 32 bit integer, then the header,
+  # padded to a multiple of 4 bytes, with the column names and number of
+  # rows, then each column as little-endian 32 bit floats with NaN for
+  # missing values.  Dates are days since 1970-01-01.
+  def pack_columns(self, columns, rows):
+    header = json.dumps({ 'columns': columns, 'rows': len(rows), 'type': 'float32' }, separators = (',', ':'))
+    header = header + ' ' * (-len(header) % 4)
+    values = numpy.array([[v if v is not None else numpy.nan for v in r] for r in rows], dtype = '<f4').reshape((len(rows), len(columns)))
+
+    return struct.pack('<I', len(header)) + header + values.T.tobytes()
+
+  # Write an export file for the current station, gzipping JSON, but only
+  # if it changed so unchanged files keep their dates
+  def write_export(self, name, data):
+    if name.endswith('.json.gz'):
+      output = StringIO.StringIO()
+      gzipped = gzip.GzipFile(filename = '', mode = 'wb', fileobj = output, mtime = 0)
+      gzipped.write(json.dumps(data, separators = (',', ':')))
+      gzipped.close()
+      data = output.getvalue()
+
+    path = os.path.join(self.export_dir, self.station[0], name)
+    if os.path.exists(path):
+      with open(path, 'rb') as current:
+        if current.read() == data:
+          return
+
+    try:
+      os.makedirs(os.path.dirname(path))
+    except OSError:
+      pass
+
+    with open(path + '.tmp', 'wb') as export:
+      export.write(data)
+    os.rename(path + '.tmp', path)
+
+
+  # Write each station's observations and normals to its archive file, for
+  # every day on or after a date (or all of them).  The file has the same
+  # header as pack_columns, padded so the columns start on a 4096 byte
+  # boundary, then a column of little-endian 32 bit floats for each of
+  # archive_columns with a value for each day from archive_start to
+  # archive_end, NaN where there is none.  The layout never changes, so
+  # recent runs write their days in place and a day's values are always at
+  # the same place in the file.  Whole files are written next to the old
+  # ones and moved over them, so anything reading the old file can finish.
+  def refresh_archives(self, since = None):
+    if not self.archive_dir:
+      return
+
+    days = (self.archive_end - self.archive_start).days
+    dates = numpy.datetime64(self.archive_start) + numpy.arange(0, days)
+    months = dates.astype('datetime64[M]')
+    month_days = (dates - months).astype(int) + 1
+    months = months.astype(int) % 12 + 1
+    observation_columns = [c for c in self.archive_columns if not c.startswith('n')]
+    normals_columns = [c for c in self.archive_columns if c.startswith('n')]
+
+    for s in self.stations:
+      station = s[0]
+      path = self.archive_path(station)
+      archive = self.open_archive(station, 'r+') if since else None
+      if archive is not None and (archive[0]['start'] != str(self.archive_start) or
+        archive[0]['rows'] != days or archive[0]['columns'] != self.archive_columns):
+        archive = None
+
+      # A whole new file is made next to the old one, replacing anything
+      # left there by a rewrite that didn't finish
+      created = archive is None
+      if created:
+        print 'Archiving station: %s' % station
+        first = 0
+        if os.path.exists(path + '.tmp'):
+          os.remove(path + '.tmp')
+        archive = self.create_archive(path + '.tmp', days)
+      else:
+        print 'Archiving station since: %s %s' % (station, since)
+        first = (since - self.archive_start).days
+      header, columns = archive
+      columns[:, first:] = numpy.nan
+
+      rows = scraperwiki.sqlite.execute('SELECT CAST(julianday(date) - julianday(?) AS INTEGER), %s FROM observations WHERE station = ? AND date >= ? AND date < ?' % (
+        ', '.join(observation_columns)), [str(self.archive_start), station, str(self.archive_start + timedelta(days = first)), str(self.archive_end)])
+      if len(rows['data']):
+        values = numpy.array(rows['data'], dtype = float)
+        index = values[:, 0].astype(int)
+        for i, c in enumerate(observation_columns):
+          columns[self.archive_columns.index(c), index] = values[:, i + 1]
+      self.count('rows_archived', len(rows['data']))
+
+      # Normals are the same each year, so each day gets them by month and
+      # day of the month
+      normals = numpy.empty((len(normals_columns), 13, 32))
+      normals[:] = numpy.nan
+      rows = scraperwiki.sqlite.execute('SELECT month, day, %s FROM normals WHERE station = ?' % ', '.join(normals_columns), [station])
+      for r in rows['data']:
+        normals[:, r[0], r[1]] = [v if v is not None else numpy.nan for v in r[2:]]
+      for i, c in enumerate(normals_columns):
+        columns[self.archive_columns.index(c), first:] = normals[i, months[first:], month_days[first:]]
+
+      columns.flush()
+      if created:
+        os.rename(path + '.tmp', path)
+
+  # Path of the archive file for a station
+  def archive_path(self, station):
+    return os.path.join(self.archive_dir, station + '.columns')
+
+  # Make an empty archive file for the days and columns this scraper
+  # archives and open it for writing
+  def create_archive(self, path, days):
+    header = json.dumps({ 'columns': self.archive_columns, 'rows': days,
+      'start': str(self.archive_start), 'type': 'float32' }, separators = (',', ':'))
+    header = header + ' ' * (-(len(header) + 4) % 4096)
+
+    try:
+      os.makedirs(os.path.dirname(path))
+    except OSError:
+      pass
+
+    with open(path, 'wb') as archive:
+      archive.write(struct.pack('<I', len(header)) + header)
+      archive.truncate(4 + len(header) + len(self.archive_columns) * days * 4)
+
+    return self.open_archive(path = path, mode = 'r+')
+
+  # Open a station's archive file, read only or with mode 'r+' for writing,
+  # as its header and a memory-mapped array with a row for each column.
+  # Returns None if there is no archive for the station.
+  def open_archive(self, station = None, mode = 'r', path = None):
+    path = path or self.archive_path(station)
+    if not os.path.exists(path):
+      return None
+
+    with open(path, 'rb') as archive:
+      length = struct.unpack('<I', archive.read(4))[0]
+      header = json.loads(archive.read(length))
+
+    return header, numpy.memmap(path, dtype = '<f4', mode = mode, offset = 4 + length,
+      shape = (len(header['columns']), header['rows']))
+
+  # Load the days from start to end (both included) of a station's archive
+  # as an OrderedDict of numpy arrays: the dates, then each measurement or
+  # the ones asked for.  The measurements are slices of the memory-mapped
+  # file, so nothing is read until they are used.  Returns None if there is
+  # no archive for the station.
+  def load_archive(self, station, start, end, measurements = None):
+    archive = self.open_archive(station)
+    if archive is None:
+      return None
+
+    header, columns = archive
+    archive_start = datetime.strptime(header['start'], '%Y-%m-%d').date()
+    first = min(max((start - archive_start).days, 0), header['rows'])
+    last = min(max((end - archive_start).days + 1, first), header['rows'])
+
+    loaded = OrderedDict([('date', numpy.datetime64(header['start']) + numpy.arange(first, last))])
+    for m in measurements or header['columns']:
+      loaded[m] = columns[header['columns'].index(m), first:last]
+
+    return loaded
+
+
+  # Download everything the run needs for all stations at once
+  def prefetch_stations(self):
+    urls = []
+    for s in self.stations:
+      self.station = s
+      urls = urls + self.station_urls()
+    self.prefetch(urls)
+
+
+  # Turn a list of row dicts into something smaller to pass between
+  # processes: a list of field names and a tuple of values per row that
+  # starts with which field names it uses
+  def pack_rows(self, rows):
+    fields = []
+    field_index = {}
+    packed = []
+    for row in rows:
+      row_fields = tuple(sorted(row.keys()))
+      if row_fields not in field_index:
+        field_index[row_fields] = len(fields)
+        fields.append(row_fields)
+      packed.append((field_index[row_fields],) + tuple(row[f] for f in row_fields))
+
+    return (fields, packed)
+
+  # Turn packed rows back into row dicts
+  def unpack_rows(self, packed_rows):
+    fields, packed = packed_rows
+    for row in packed:
+      yield dict(zip(fields[row[0]], row[1:]))
+
+  # Parse the GHCN and normals files of each station with a pool of
+  # processes.  The rows are saved here in station order, so the result is
+  # the same as doing it one station at a time
+  def process_stations_in_parallel(self):
+    pool = multiprocessing.Pool(min(self.processes, len(self.stations)))
+
+    try:
+      parsed = pool.imap(parse_station_files, [(self, s) for s in self.stations])
+      for s in self.stations:
+        self.station = s
+        ghcn, normals = parsed.next()
+        print 'Saving parsed GHCN and Normals files for station: %s' % self.station[0]
+        self.save_ghcn(ghcn)
+        self.save_normals(self.unpack_rows(normals))
+        self.process_mn_climate()
+    finally:
+      pool.close()
+      pool.join()
+
+
+  # Add to a count for the stage the run is in.  Rows are counted for
+  # each table they are saved to
+  def count(self, name, amount = 1):
+    with stats_lock:
+      stats = self.stages.setdefault(self.stage or 'run', OrderedDict())
+      stats[name] = stats.get(name, 0) + amount
+
+  # Run part of a run as a named stage and time it.  Stages with the same
+  # name, like the same source for each station, add up
+  def run_stage(self, name, method, *args):
+    previous = self.stage
+    self.stage = name
+    started = time.time()
+    try:
+      return method(*args)
+    finally:
+      self.count('seconds', time.time() - started)
+      self.stage = previous
+
+  # Start counting for a run
+  def start_run(self):
+    self.stages = OrderedDict()
+    self.run_started = datetime.now()
+
+  # Report what a run did, as JSON: the time and counts of each stage,
+  # like downloads, rows parsed and written and time spent writing to the
+  # database.  Stations parsed in other processes only count their time.
+  def finish_run(self, mode):
+    finished = datetime.now()
+    report = OrderedDict([
+      ('mode', mode),
+      ('started', str(self.run_started)),
+      ('finished', str(finished)),
+      ('seconds', round((finished - self.run_started).total_seconds(), 3)),
+      ('stations', [s[0] for s in self.stations]),
+      ('stages', OrderedDict((name, OrderedDict((k, round(v, 3) if isinstance(v, float) else v) for k, v in stats.items()))
+        for name, stats in self.stages.items()))
+    ])
+    report = json.dumps(report, indent = 2)
+    print 'Run report: %s' % report
+
+    if self.report_path:
+      with open(self.report_path, 'wb') as report_file:
+        report_file.write(report)
+
+    if self.save_runs:
+      scraperwiki.sqlite.execute('CREATE TABLE IF NOT EXISTS runs (mode TEXT, started TEXT, finished TEXT, seconds REAL, report TEXT)')
+      scraperwiki.sqlite.execute('CREATE INDEX IF NOT EXISTS runs_started ON runs (started)')
+      scraperwiki.sqlite.execute('INSERT INTO runs (mode, started, finished, seconds, report) VALUES (?, ?, ?, ?, ?)',
+        [mode, str(self.run_started), str(finished), (finished - self.run_started).total_seconds(), report])
+      scraperwiki.sqlite.commit()
 
 
   # Process historical records
   def process_historical(self):
     self.isRecent = False
+    self.start_run()
+    self.run_stage('migrate', self.migrate_schema)
+    self.run_stage('prefetch', self.prefetch_stations)
 
-    for s in self.stations:
-      self.station = s
-      self.process_ghcn()
-      self.process_normals()
-      self.process_mn_climate()
+    if self.processes > 1 and len(self.stations) > 1:
+      self.run_stage('stations', self.process_stations_in_parallel)
+    else:
+      for s in self.stations:
+        self.station = s
+        self.run_stage('ghcn', self.process_ghcn)
+        self.run_stage('normals', self.process_normals)
+        self.run_stage('mn_climate', self.process_mn_climate)
+
+    self.run_stage('merge', self.merge_observations)
+    self.run_stage('validate', self.validate_sources)
+    self.run_stage('records', self.refresh_day_records)
+    self.run_stage('summaries', self.refresh_summaries)
+    self.run_stage('export', self.export_summaries)
+    self.run_stage('archive', self.refresh_archives)
+    self.finish_run('historical')
 
 
   # Process recent records
   def process_recent(self):
     self.isRecent = True
+    self.start_run()
+    self.run_stage('migrate', self.migrate_schema)
+    self.run_stage('prefetch', self.prefetch_stations)
 
     for s in self.stations:
       self.station = s
-      self.process_ghcn()
-      self.process_gsod()
-      self.process_nws_monthly()
-      self.process_nws_recent()
+      self.run_stage('ghcn', self.process_ghcn)
+      self.run_stage('gsod', self.process_gsod)
+      self.run_stage('nws', self.process_nws_monthly)
+      self.run_stage('nws_recent', self.process_nws_recent)
+
+    # Recent runs only change days from the start of the recent month on
+    since = date(self.recent.year, self.recent.month, 1)
+    self.run_stage('merge', self.merge_observations, since)
+    self.run_stage('validate', self.validate_sources, since)
+    self.run_stage('records', self.refresh_day_records, since)
+    self.run_stage('summaries', self.refresh_summaries, since)
+    self.run_stage('export', self.export_summaries, since)
+    self.run_stage('archive', self.refresh_archives, since)
+    self.finish_run('recent')
+
+
+  # Import GHCN and GSOD data from NOAA's bulk archives on disk, such as
+  # ghcnd_all.tar.gz and the yearly gsod_2013.tar files, in one pass.  Each
+  # archive is streamed and only the files for our stations are parsed,
+  # with the same parsers as everything else.
+  def process_archives(self, paths):
+    self.isRecent = False
+    self.start_run()
+    self.run_stage('migrate', self.migrate_schema)
+    ghcn_stations = dict((s[0], s) for s in self.stations)
+    gsod_stations = dict((s[1], s) for s in self.stations)
+
+    for path in paths:
+      print 'Reading archive: %s' % path
+      archive = tarfile.open(path, 'r|*')
+
+      for member in archive:
+        if not member.isfile():
+          continue
+
+        # GHCN files are named by station, like USW00014922.dly, and GSOD
+        # files by station and year, like 726580-14922-2013.op.gz
+        name = os.path.basename(member.name)
+        station = name.split('.')[0]
+        if name.endswith('.dly') and station in ghcn_stations:
+          self.station = ghcn_stations[station]
+          print 'Parsing GHCN file in archive for station: %s' % self.station[0]
+          file = archive.extractfile(member)
+          self.run_stage('ghcn', self.save_ghcn, self.read_ghcn(file))
+          file.close()
+        elif name.endswith('.op.gz') and station.rsplit('-', 1)[0] in gsod_stations:
+          self.station = gsod_stations[station.rsplit('-', 1)[0]]
+          print 'Parsing GSOD file in archive for station: %s and year: %s' % (self.station[1], station.rsplit('-', 1)[1])
+          file = GzipLines(archive.extractfile(member))
+          self.run_stage('gsod', self.save_gsod, self.read_gsod(file))
+          file.close()
+
+      archive.close()
+
+    self.run_stage('merge', self.merge_observations)
+    self.run_stage('validate', self.validate_sources)
+    self.run_stage('records', self.refresh_day_records)
+    self.run_stage('summaries', self.refresh_summaries)
+    self.run_stage('export', self.export_summaries)
+    self.run_stage('archive', self.refresh_archives)
+    self.finish_run('archives')
+
+
+# Parse a station's GHCN and normals files in a worker process and return
+# the GHCN values and the normals as packed rows.  This has to be a plain
+# function so that it can be handed to a process pool
+def parse_station_files(args):
+  scraper, station = args
+  scraper.station = station
+
+  print 'Parsing GHCN and Normals files for station: %s' % station[0]
+  file = scraper.read_url(scraper.ghcn_url(), False)
+  ghcn = list(scraper.read_ghcn(file)) if file is not None else []
+  if file is not None:
+    file.close()
+
+  file_lines = scraper.read_url(scraper.normals_url(), True, True)
+  normals = scraper.pack_rows(scraper.read_normals(file_lines) if file_lines is not None else [])
+
+  return (ghcn, normals)
+
+
+# Lines of a gzipped file, decompressed a chunk at a time as they are read
+# from a response or an open file, so the whole file is never in memory.
+# Files with more than one gzip member, like concatenated downloads, are
+# read through.
+class GzipLines:
+
+  chunk_size = 65536
+
+  def __init__(self, stream):
+    self.stream = stream
+
+  def __iter__(self):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = ''
+
+    for chunk in iter(lambda: self.stream.read(self.chunk_size), ''):
+      while chunk:
+        pending = pending + decompressor.decompress(chunk)
+        chunk = decompressor.unused_data
+        if chunk:
+          pending = pending + decompressor.flush()
+          decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        # Hand out every full line we have so far
+        start = 0
+        end = pending.find('\n')
+        while end >= 0:
+          yield pending[start:end + 1]
+          start = end + 1
+          end = pending.find('\n', start)
+        pending = pending[start:]
+
+    pending = pending + decompressor.flush()
+    if pending != '':
+      yield pending
+
+  def readlines(self):
+    lines = list(self)
+    self.close()
+    return lines
+
+  def close(self):
+    self.stream.close()
 
 
 # Main execution
 if __name__ == '__main__':
   scraper = DailyWeatherScraper()
   #scraper.process_historical()
+  #scraper.process_archives(['ghcnd_all.tar.gz', 'gsod_2013.tar'])
   scraper.process_recent()
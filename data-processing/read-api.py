@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+# A small read only service over the scraper's database, to stand in for
+# the ScraperWiki SQL endpoint.  Run it next to the database with:
+#   python data-processing/read-api.py
+# See the README for the endpoints.
+
+import os
+import re
+import time
+import json
+import sqlite3
+import hashlib
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+from collections import OrderedDict
+from datetime import datetime
+
+
+# Results of queries, by endpoint and parameters, for a limited time and
+# only as long as no scraper run has finished since they were made
+class QueryCache:
+  # Constructor
+  def __init__(self, size, ttl):
+    self.size = size
+    self.ttl = ttl
+    self.entries = OrderedDict()
+    self.generation = None
+    self.lock = threading.Lock()
+
+  # Get the body and ETag for a key, or None if it is not there, is too
+  # old or was made before the latest run
+  def get(self, key, generation):
+    with self.lock:
+      self.invalidate(generation)
+      entry = self.entries.pop(key, None)
+      if entry is None or entry[0] < time.time():
+        return None
+
+      # Most recently used goes at the end
+      self.entries[key] = entry
+      return entry[1], entry[2]
+
+  # Keep the body and ETag for a key, dropping the least recently used
+  # entries if there are too many.  Results made from before the latest run
+  # are not kept
+  def put(self, key, generation, body, etag):
+    with self.lock:
+      if generation != self.generation:
+        return
+
+      self.entries.pop(key, None)
+      self.entries[key] = (time.time() + self.ttl, body, etag)
+      while len(self.entries) > self.size:
+        self.entries.popitem(last = False)
+
+  # Drop everything if a run has finished or the database has changed
+  # since the entries were made
+  def invalidate(self, generation):
+    if generation != self.generation:
+      self.entries.clear()
+      self.generation = generation
+
+
+# The service, with the queries for each endpoint
+class ReadAPI:
+  # Where the scraper's database is and where to listen
+  database = os.environ.get('SCRAPERWIKI_DATABASE_NAME', 'scraperwiki.sqlite')
+  host = os.environ.get('CLIMATE_API_HOST', '127.0.0.1')
+  port = int(os.environ.get('CLIMATE_API_PORT', 8000))
+
+  # How many results to keep and for how many seconds
+  cache_size = 256
+  cache_ttl = 300
+
+  # Columns returned for each day, and the normals and departures added
+  # when asked for
+  day_columns = ['station', 'date', 'tmax', 'tmin', 'tavg', 'prcp', 'snow', 'snwd']
+  normals_columns = ['ntmax', 'ntmin', 'ntavg', 'nprcp', 'nsnow',
+    'tmax_departure', 'tmin_departure', 'tavg_departure', 'prcp_departure', 'snow_departure']
+
+  # Dates, months and years as they can be given for a range
+  range_formats = {
+    'days': (re.compile(r'^\d{4}-\d{2}-\d{2}$'), '%Y-%m-%d'),
+    'months': (re.compile(r'^\d{4}-\d{2}$'), '%Y-%m'),
+    'years': (re.compile(r'^\d{4}$'), '%Y')
+  }
+
+
+  # Constructor
+  def __init__(self, database = None, cache_size = None, cache_ttl = None):
+    self.database = database or self.database
+    self.cache = QueryCache(cache_size or self.cache_size, cache_ttl or self.cache_ttl)
+    self.local = threading.local()
+
+  # Each request thread has its own connection
+  def connection(self):
+    if getattr(self.local, 'connection', None) is None:
+      self.local.connection = sqlite3.connect(self.database)
+      self.local.connection.row_factory = sqlite3.Row
+
+    return self.local.connection
+
+  # Something that changes each time a scraper run finishes: the last run
+  # saved to the runs table, or 0 if runs are not saved, and the time the
+  # database was last written to
+  def generation(self):
+    try:
+      last_run = self.connection().execute('SELECT MAX(rowid) FROM runs').fetchone()[0] or 0
+    except sqlite3.OperationalError:
+      last_run = 0
+
+    return (last_run, os.stat(self.database).st_mtime)
+
+  # Answer a request for a path and its parameters, from the cache if
+  # possible.  Returns the status, the JSON body and its ETag
+  def respond(self, path, params):
+    endpoint = path.strip('/')
+    if endpoint not in self.range_formats:
+      return 404, json.dumps({ 'error': 'Unknown endpoint: %s' % path }), None
+
+    try:
+      query = self.query(endpoint, params)
+    except ValueError as e:
+      return 400, json.dumps({ 'error': str(e) }), None
+
+    generation = self.generation()
+    cached = self.cache.get(query, generation)
+    if cached is not None:
+      return (200,) + cached
+
+    rows = self.connection().execute(query[0], query[1]).fetchall()
+    body = json.dumps([OrderedDict(zip(r.keys(), r)) for r in rows], separators = (',', ':'))
+    etag = '"%s"' % hashlib.md5(body).hexdigest()
+    self.cache.put(query, generation, body, etag)
+    return 200, body, etag
+
+  # Make the SQL and values for an endpoint from the parameters: start and
+  # end of the range (both included), station, and for days, whether to
+  # include normals, which leaves out days without them
+  def query(self, endpoint, params):
+    start = self.range_value(endpoint, params.get('start'), '0001-01-01')
+    end = self.range_value(endpoint, params.get('end'), '9999-12-31')
+    station = params.get('station')
+    values = []
+
+    if endpoint == 'days':
+      normals = params.get('normals') in ['1', 'true', 'yes']
+      sql = 'SELECT %s FROM daily_summary WHERE date >= ? AND date <= ?' % ', '.join(self.day_columns + (self.normals_columns if normals else []))
+      values = [start, end]
+      sql = sql + (' AND ntavg IS NOT NULL' if normals else '')
+    elif endpoint == 'months':
+      sql = 'SELECT * FROM monthly_summary WHERE year * 100 + month >= ? AND year * 100 + month <= ?'
+      values = [int(start[0:4]) * 100 + int(start[5:7]), int(end[0:4]) * 100 + int(end[5:7])]
+    else:
+      sql = 'SELECT * FROM yearly_summary WHERE year >= ? AND year <= ?'
+      values = [int(start[0:4]), int(end[0:4])]
+
+    if station:
+      sql = sql + ' AND station = ?'
+      values.append(station)
+
+    sql = sql + ' ORDER BY %s, station' % ('date' if endpoint == 'days' else 'year, month' if endpoint == 'months' else 'year')
+    return (sql, tuple(values))
+
+  # Check a start or end value is a date, month or year as the endpoint
+  # needs, and return it as a full date, or the default if there is none
+  def range_value(self, endpoint, value, default):
+    if value is None or value == '':
+      return default
+
+    pattern, format = self.range_formats[endpoint]
+    try:
+      if not pattern.match(value):
+        raise ValueError
+      return datetime.strptime(value, format).strftime('%Y-%m-%d')
+    except ValueError:
+      raise ValueError('Not a valid %s value: %s' % (endpoint[:-1], value))
+
+  # Start listening
+  def serve(self):
+    api = self
+
+    # Each request is answered as JSON, or JSONP if there is a callback,
+    # with an ETag so repeated requests can be answered with no body
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+      def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        callback = params.pop('callback', None)
+        status, body, etag = api.respond(url.path, params)
+
+        if callback:
+          if not re.match(r'^[\w$.]+$', callback):
+            status, body, etag = 400, json.dumps({ 'error': 'Not a valid callback' }), None
+          else:
+            body = '%s(%s);' % (callback, body)
+            etag = etag and '"%s"' % hashlib.md5(etag + callback).hexdigest()
+
+        if etag and etag == self.headers.get('If-None-Match'):
+          self.send_response(304)
+          self.send_header('ETag', etag)
+          self.end_headers()
+          return
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/javascript' if callback and status == 200 else 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Cache-Control', 'no-cache')
+        if etag:
+          self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+      daemon_threads = True
+
+    print 'Serving %s on http://%s:%s/' % (self.database, self.host, self.port)
+    Server((self.host, self.port), Handler).serve_forever()
+
+
+# Main execution
+if __name__ == '__main__':
+  api = ReadAPI()
+  api.serve()
@@ -248,18 +248,26 @@ define('minnpost-climate', [
       // but this could be change to be more accurate
       var recent = moment(this.date).subtract('months', 5);
       var query = [];
-
-      query.push("SELECT");
-      query.push("  o.date, o.tmax, o.tmin,");
-      query.push("  n.ntmax, n.ntmin, n.ntavg,");
-      query.push("    CASE WHEN tavg IS NULL THEN ROUND((o.tmax + o.tmin) / 2, 2)");
-      query.push("      ELSE tavg END AS tavg");
-      query.push("FROM observations AS o");
-      query.push("  INNER JOIN normals AS n ON");
-      query.push("    o.month = n.month AND o.day = n.day");
-      query.push("WHERE o.date > DATE('" + recent.format('YYYY-MM-DD') + "')");
-      query.push("  AND o.date <= DATE('" + this.date.format('YYYY-MM-DD') + "')");
-      var url = this.options.dailyObservationsPath.replace('[[[QUERY]]]', encodeURIComponent(query.join(' ')));
+      var url;
+
+      // The scraper's read API (data-processing/read-api.py) has the
+      // same days with normals by date range, and caches them
+      if (this.options.dailyObservationsAPIPath) {
+        url = this.options.dailyObservationsAPIPath +
+          'days?normals=1&callback=?' +
+          '&start=' + moment(recent).add('days', 1).format('YYYY-MM-DD') +
+          '&end=' + this.date.format('YYYY-MM-DD');
+      }
+      else {
+        // The scraper keeps observations joined with normals in daily_summary
+        query.push("SELECT");
+        query.push("  date, tmax, tmin, ntmax, ntmin, ntavg, tavg");
+        query.push("FROM daily_summary");
+        query.push("WHERE date > DATE('" + recent.format('YYYY-MM-DD') + "')");
+        query.push("  AND date <= DATE('" + this.date.format('YYYY-MM-DD') + "')");
+        query.push("  AND ntavg IS NOT NULL");
+        url = this.options.dailyObservationsPath.replace('[[[QUERY]]]', encodeURIComponent(query.join(' ')));
+      }
 
       // Make request
       return $.getJSON(url).done(function(data) {
@@ -353,6 +361,9 @@ define('minnpost-climate', [
     // Default options
     defaultOptions: {
       dailyObservationsPath: 'https://premium.scraperwiki.com/d7fssyq/a43576483d6f43a/sql/?callback=?&q=[[[QUERY]]]',
+      // Set to where the read API is served, like 'http://localhost:8000/',
+      // to use it instead of the SQL endpoint
+      dailyObservationsAPIPath: null,
       seasons: {
         // Start is inclusive
         winter: {